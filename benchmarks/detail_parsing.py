@@ -0,0 +1,122 @@
+#! /usr/local/bin/python3
+""" Check detail_parser against the line-by-line parse lookup_programs used to do, and time both.
+
+    The IRPSL3 pages come from a page cache filled by registered_programs.py --cache. For each
+    page, both parsers must produce the same records; any difference is reported and the exit
+    status is non-zero.
+
+    Usage: benchmarks/detail_parsing.py [cache_dir] [-r repeat]
+"""
+import argparse
+import json
+import re
+import sys
+import time
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from detail_parser import (parse_detail_page, DetailParseError, ProgramLine,  # noqa: E402
+                           MultiInstitution, NotGranting, ForAward, Certificate, Financial,
+                           Accreditation, Dates)
+from page_cache import DEFAULT_CACHE_DIR, Page  # noqa: E402
+
+
+def legacy_parse(page):
+  """ The lines lookup_programs used to select and the values it extracted from them, as records.
+  """
+  records = []
+  for_award = None
+  for line in page.replace('\x1e', '').splitlines():
+    if not re.search(r'^\s+\d{5}\s+|FOR AWARD|PROGRAM|CERTIFICATE|M/A|M/I', line):
+      continue
+    line = line.replace('<H4><PRE>', '').strip()
+    tokens = line.split()
+    token = tokens[0]
+    if token.isdecimal() or token == 'M/A':
+      matches = re.match(r'\s*(\d+|M/A)\s+(.+)(\d{4}\.\d{2})\s+(\S+\s?\S*)\s+(.+)', line)
+      if matches is None:
+        raise DetailParseError('program code', line)
+      records.append((line, ProgramLine(matches.group(1), matches.group(2), matches.group(3),
+                                        matches.group(4).strip(), matches.group(5))))
+      continue
+    if token == 'M/I':
+      if 'NOT-GRANTING' in line:
+        matches = re.search(r'NOT-GRANTING\s+(.+)', line)
+        if matches is None:
+          raise DetailParseError('M/I', line)
+        records.append((line, NotGranting(matches.group(1).strip())))
+      else:
+        matches = re.search(r'(\d{4}.\d{2})\s+(\S+\s?\S*)\s+(.*)', line)
+        if matches is None:
+          raise DetailParseError('M/I', line)
+        records.append((line, MultiInstitution(matches.group(1), matches.group(2).strip(),
+                                               matches.group(3).strip())))
+      continue
+    if token == 'FOR':
+      for_award = re.match(r'\s*FOR AWARD\s*--(.*)', line).group(1).strip()
+      records.append((line, ForAward(for_award)))
+    if token.startswith('CERTIFICATE') and for_award is not None:
+      cert_info = re.sub(r'\s+', ' ', line.split(':')[1].strip())
+      if cert_info.startswith('NONE'):
+        cert_info = ''
+      records.append((line, Certificate(cert_info)))
+      continue
+    if token == 'PROGRAM' and tokens[1] == 'FINANCIAL' and for_award is not None:
+      matches = re.search(r'(YES|NO).+(YES|NO).+(YES|NO)', line)
+      if matches is None:
+        raise DetailParseError('eligibility', line)
+      records.append((line, Financial(matches.group(1), matches.group(2), matches.group(3))))
+      continue
+    if token == 'PROGRAM' and tokens[1] == 'PROFESSIONAL' and for_award is not None:
+      records.append((line, Accreditation(line.split(':')[1].strip())))
+      continue
+    if token == 'PROGRAM' and tokens[1] == 'FIRST' and for_award is not None:
+      matches = re.search(r'DATE:\s+(\S+).+ACTION:\s+(\S+)', line)
+      if matches is None:
+        raise DetailParseError('registration dates', line)
+      records.append((line, Dates(matches[1], matches[2])))
+  return records
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compare and time detail page parsers.')
+  parser.add_argument('cache_dir', nargs='?', default=DEFAULT_CACHE_DIR)
+  parser.add_argument('-r', '--repeat', type=int, default=20)
+  args = parser.parse_args()
+
+  pages = []
+  for meta_file in Path(args.cache_dir).glob('*/*.json'):
+    meta = json.loads(meta_file.read_text())
+    if 'IRPSL3' in meta['url']:
+      page = Page(meta_file.with_suffix('.body').read_bytes(), meta['encoding'])
+      pages.append((meta['url'], page.text))
+  if not pages:
+    sys.exit(f'No detail pages in {args.cache_dir}')
+
+  mismatches = 0
+  num_lines = 0
+  for url, text in pages:
+    num_lines += text.count('\n') + 1
+    if legacy_parse(text) != list(parse_detail_page(text)):
+      mismatches += 1
+      print(f'MISMATCH: {url}', file=sys.stderr)
+
+  times = {'legacy': 0.0, 'detail_parser': 0.0}
+  for _ in range(args.repeat):
+    start = time.perf_counter()
+    for url, text in pages:
+      legacy_parse(text)
+    times['legacy'] += time.perf_counter() - start
+    start = time.perf_counter()
+    for url, text in pages:
+      list(parse_detail_page(text))
+    times['detail_parser'] += time.perf_counter() - start
+
+  print(f'{len(pages):,} pages; {num_lines:,} lines; {mismatches} mismatches')
+  for method, total in times.items():
+    print(f'{method:>14}: {len(pages) * args.repeat / total:10,.0f} pages/s '
+          f'{num_lines * args.repeat / total:12,.0f} lines/s')
+  print(f'{"speedup":>14}: {times["legacy"] / times["detail_parser"]:10.2f}×')
+  sys.exit(1 if mismatches else 0)
@@ -0,0 +1,115 @@
+#! /usr/local/bin/python3
+""" Micro-benchmark: time spent resolving institution names per NYSED page, using the linear scans
+    of known_institutions that lookup_programs used to do, and using an InstitutionIndex.
+
+    The pages come from a page cache filled by registered_programs.py --cache, so the numbers can
+    be reproduced against the same pages. Institutions come from the nys_institutions table.
+
+    Usage: benchmarks/institution_lookups.py [cache_dir] [-r repeat]
+"""
+import argparse
+import json
+import psycopg
+import re
+import sys
+import time
+
+from pathlib import Path
+from psycopg.rows import namedtuple_row
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from institution_index import InstitutionIndex  # noqa: E402
+from page_cache import DEFAULT_CACHE_DIR, Page  # noqa: E402
+from lxml.html import document_fromstring  # noqa: E402
+
+
+def page_lookups(url, page):
+  """ The (kind, text) lookups lookup_programs does for one page: 'substring' for Phase I H4
+      elements, 'exact' for Phase II program-code, M/A, and M/I lines.
+  """
+  lookups = []
+  if 'IRPS2A' in url:
+    for h4 in document_fromstring(page.content).cssselect('h4'):
+      text = h4.text_content()
+      if re.search(r'HEGIS : (\S+)', text):
+        lookups.append(('substring', text))
+  elif 'IRPSL3' in url:
+    for line in page.text.replace('\x1e', '').splitlines():
+      line = line.replace('<H4><PRE>', '').strip()
+      tokens = line.split()
+      if not tokens:
+        continue
+      if tokens[0].isdecimal() or tokens[0] == 'M/A':
+        matches = re.match(r'\s*(\d+|M/A)\s+(.+)(\d{4}\.\d{2})\s+(\S+\s?\S*)\s+(.+)', line)
+        if matches:
+          lookups.append(('exact', matches.group(5)))
+      elif tokens[0] == 'M/I':
+        matches = (re.search(r'NOT-GRANTING\s+(.+)', line)
+                   or re.search(r'(\d{4}.\d{2})\s+(\S+\s?\S*)\s+(.*)', line))
+        if matches:
+          lookups.append(('exact', matches.groups()[-1].strip()))
+  return lookups
+
+
+def linear(known_institutions, lookups):
+  """ The lookups as they used to be done. """
+  for kind, text in lookups:
+    for inst in known_institutions:
+      name = known_institutions[inst][1]
+      if (name in text) if kind == 'substring' else (name == text):
+        break
+
+
+def indexed(index, lookups):
+  """ The lookups using an InstitutionIndex. """
+  for kind, text in lookups:
+    if kind == 'substring':
+      index.find_in(text)
+    else:
+      index.exact(text)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Time institution-name lookups per page.')
+  parser.add_argument('cache_dir', nargs='?', default=DEFAULT_CACHE_DIR)
+  parser.add_argument('-r', '--repeat', type=int, default=20)
+  args = parser.parse_args()
+
+  with psycopg.connect('dbname=cuny_curriculum') as conn:
+    with conn.cursor(row_factory=namedtuple_row) as cursor:
+      cursor.execute('select * from nys_institutions')
+      known_institutions = {row.id: (row.institution_id, row.institution_name, row.is_cuny)
+                            for row in cursor.fetchall()}
+
+  start = time.perf_counter()
+  index = InstitutionIndex(known_institutions)
+  build_time = time.perf_counter() - start
+
+  pages = []
+  for meta_file in Path(args.cache_dir).glob('*/*.json'):
+    meta = json.loads(meta_file.read_text())
+    page = Page(meta_file.with_suffix('.body').read_bytes(), meta['encoding'])
+    lookups = page_lookups(meta['url'], page)
+    if lookups:
+      pages.append(lookups)
+  if not pages:
+    sys.exit(f'No NYSED pages in {args.cache_dir}')
+
+  times = {'linear': 0.0, 'indexed': 0.0}
+  for lookups in pages:
+    for _ in range(args.repeat):
+      start = time.perf_counter()
+      linear(known_institutions, lookups)
+      times['linear'] += time.perf_counter() - start
+      start = time.perf_counter()
+      indexed(index, lookups)
+      times['indexed'] += time.perf_counter() - start
+
+  num_lookups = sum(len(lookups) for lookups in pages)
+  print(f'{len(known_institutions):,} institutions; index built in {build_time * 1000:.1f} ms')
+  print(f'{len(pages):,} pages; {num_lookups:,} lookups')
+  for method, total in times.items():
+    per_page = total / (len(pages) * args.repeat) * 1e6
+    print(f'{method:>8}: {per_page:10.1f} µs per page')
+  print(f' speedup: {times["linear"] / times["indexed"]:10.1f}×')
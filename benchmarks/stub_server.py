@@ -0,0 +1,142 @@
+#! /usr/local/bin/python3
+""" Local HTTP server that stands in for the NYSED websites, replaying recorded pages.
+
+    The pages come from a fixture directory in page cache format (see page_cache.py), filled by
+    benchmarks/suite.py record or by registered_programs.py --cache. Requests are matched on
+    method, path and query, and form data, ignoring the host, so one server can replay the
+    www2.nysed.gov registration pages and the www.nysed.gov HEGIS and format definition pages.
+    Requests for pages that were not recorded get a 404.
+
+    Point the scrapers at the server by setting NYSED_URL and NYSED_WWW_URL to its URL; see
+    nysed_fetch.py.
+
+    Usage: benchmarks/stub_server.py [fixture_dir] [-p port] [-l latency_ms]
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+DEFAULT_FIXTURE_DIR = Path(__file__).resolve().parent / 'fixtures'
+
+# (method, path with query, sorted form data or None)
+RequestKey = Tuple[str, str, Optional[Tuple[Tuple[str, str], ...]]]
+
+
+def request_key(method: str, url: str, data: Optional[dict]) -> RequestKey:
+  parts = urlsplit(url)
+  path = parts.path + (f'?{parts.query}' if parts.query else '')
+  if data is None:
+    return method, path, None
+  return method, path, tuple(sorted((str(k), str(v)) for k, v in data.items()))
+
+
+def load_fixtures(fixture_dir) -> Dict[RequestKey, Tuple[Path, str]]:
+  """ Index the recorded pages: request key -> (body file, encoding).
+  """
+  fixtures = {}
+  for meta_file in Path(fixture_dir).glob('*/*.json'):
+    meta = json.loads(meta_file.read_text())
+    method = 'GET' if meta['data'] is None else 'POST'
+    fixtures[request_key(method, meta['url'], meta['data'])] = (meta_file.with_suffix('.body'),
+                                                                meta['encoding'])
+  return fixtures
+
+
+# class StubServer
+# -------------------------------------------------------------------------------------------------
+class StubServer(object):
+  """ Serve recorded pages from a background thread. Use as a context manager, or call start() and
+      stop(). Each response can be delayed by latency seconds to mimic the real site.
+  """
+
+  def __init__(self, fixture_dir=DEFAULT_FIXTURE_DIR, host='127.0.0.1', port=0,
+               latency: float = 0.0):
+    self.fixtures = load_fixtures(fixture_dir)
+    self.latency = latency
+    self.requests = self.misses = 0
+    self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+    self._httpd.daemon_threads = True
+    self._thread: Optional[threading.Thread] = None
+
+  @property
+  def url(self) -> str:
+    host, port = self._httpd.server_address[:2]
+    return f'http://{host}:{port}'
+
+  def _handler_class(self):
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        self._reply(request_key('GET', self.path, None))
+
+      def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('latin-1')
+        self._reply(request_key('POST', self.path, dict(parse_qsl(body, keep_blank_values=True))))
+
+      def _reply(self, key):
+        server.requests += 1
+        if server.latency:
+          time.sleep(server.latency)
+        fixture = server.fixtures.get(key)
+        if fixture is None:
+          server.misses += 1
+          self.send_error(404, 'Not recorded')
+          return
+        body_file, encoding = fixture
+        content = body_file.read_bytes()
+        self.send_response(200)
+        self.send_header('Content-Type', f'text/html; charset={encoding}')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+      def log_message(self, format, *args):
+        pass
+
+    return Handler
+
+  def start(self):
+    self._thread = threading.Thread(target=self._httpd.serve_forever, name='stub_server',
+                                    daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._httpd.shutdown()
+    self._httpd.server_close()
+    if self._thread is not None:
+      self._thread.join()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc_info):
+    self.stop()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Replay recorded NYSED pages over HTTP.')
+  parser.add_argument('fixture_dir', nargs='?', default=DEFAULT_FIXTURE_DIR)
+  parser.add_argument('-p', '--port', type=int, default=8000)
+  parser.add_argument('-l', '--latency', type=float, default=0.0, metavar='MS',
+                      help='delay each response by this many milliseconds')
+  args = parser.parse_args()
+
+  server = StubServer(args.fixture_dir, port=args.port, latency=args.latency / 1000)
+  if not server.fixtures:
+    sys.exit(f'No recorded pages in {args.fixture_dir}')
+  print(f'Serving {len(server.fixtures):,} pages at {server.url}', file=sys.stderr)
+  print(f'  export NYSED_URL={server.url} NYSED_WWW_URL={server.url}', file=sys.stderr)
+  try:
+    server._httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,271 @@
+#! /usr/local/bin/python3
+""" Benchmark suite for the NYSED scrapers, run against recorded pages instead of the real site.
+
+    record: Fetch the pages for the given institutions (the Phase I IRPS2A list and the Phase II
+            IRPSL3 detail pages), plus the institution list, HEGIS, and format definition pages,
+            into a fixture directory in page cache format.
+
+    run:    Replay the fixtures through benchmarks/stub_server.py and measure
+              * parse throughput (pages/s, lines/s) for each kind of page;
+              * lookup_programs latency for each recorded institution, fetching from the stub;
+              * with --db, generate_html time, after seeding registered_programs with the scraped
+                programs. The table is re-created from registered_programs.sql in the scratch
+                database given by --dsn (which must already have the other tables generate_html
+                reads: hegis_codes, nys_institutions, cuny_institutions, cuny_programs, and so on).
+                The live cuny_curriculum database is refused.
+            The results are written as JSON (by default benchmarks/results/<commit>.json), and
+            --compare shows the ratio of each measurement to the one in an earlier results file.
+
+    Usage: benchmarks/suite.py record [-f fixture_dir] institution...
+           benchmarks/suite.py run [-f fixture_dir] [-r repeat] [--workers n] [--latency ms]
+                                   [--db --dsn conninfo] [-o results.json]
+                                   [--compare old_results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from page_cache import Page, PageCache  # noqa: E402
+from stub_server import DEFAULT_FIXTURE_DIR, StubServer  # noqa: E402
+
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+SCHEMA_FILE = Path(__file__).resolve().parent.parent / 'registered_programs.sql'
+
+# The database the nightly update maintains, which the benchmarks must not write to.
+LIVE_DBNAME = 'cuny_curriculum'
+
+
+def page_kind(url):
+  """ Which of the recorded kinds of page a URL is for. """
+  for marker, kind in (('IRPSL3', 'detail'), ('IRPS2A', 'programs'), ('IRPSL1', 'institutions'),
+                       ('hegis-codes', 'hegis'), ('format-definitions', 'formats')):
+    if marker in url:
+      return kind
+  return None
+
+
+def fixture_pages(fixture_dir):
+  """ Yield (kind, url, data, page) for each recorded page. """
+  for meta_file in sorted(Path(fixture_dir).glob('*/*.json')):
+    meta = json.loads(meta_file.read_text())
+    kind = page_kind(meta['url'])
+    if kind is not None:
+      yield kind, meta['url'], meta['data'], Page(meta_file.with_suffix('.body').read_bytes(),
+                                                  meta['encoding'])
+
+
+# record
+# -------------------------------------------------------------------------------------------------
+def record(args):
+  from nysed_fetch import FORMATS_URL, HEGIS_URL, INSTITUTIONS_URL, fetch_page
+  from registered_programs import lookup_programs
+
+  cache = PageCache(args.fixtures, ttl=None, max_bytes=None)
+  for url, data in ((INSTITUTIONS_URL, {'Searches': '1'}), (HEGIS_URL, None), (FORMATS_URL, None)):
+    fetch_page(url, data=data, cache=cache)
+  for institution in args.institutions:
+    programs = lookup_programs(institution.lower(), verbose=True, workers=args.workers,
+                               rate=args.rate, cache=cache)
+    print(f'{institution}: {len(programs)} programs', file=sys.stderr)
+  print(f'{cache.misses:,} pages recorded in {args.fixtures}', file=sys.stderr)
+
+
+# run
+# -------------------------------------------------------------------------------------------------
+def parse_throughput(pages, repeat):
+  """ Pages/s and lines/s for parsing each kind of page the way the scrapers do. """
+  from detail_parser import parse_detail_page
+  from lxml.html import document_fromstring
+
+  parsers = {
+      'detail': lambda page: list(parse_detail_page(page.text)),
+      'programs': lambda page: [h4.text_content()
+                                for h4 in document_fromstring(page.content).cssselect('h4')],
+      'institutions': lambda page: [option.text_content() for option
+                                    in document_fromstring(page.content).cssselect('option')],
+      'hegis': lambda page: [[cell.text_content() for cell in row] for table
+                             in document_fromstring(page.content).iter('table')
+                             for row in table.iter('tr')],
+      'formats': lambda page: [p.text_content() for p
+                               in document_fromstring(page.content).cssselect('.field__items p')],
+  }
+  results = {}
+  for kind, parse in parsers.items():
+    kind_pages = [page for page_kind, url, data, page in pages if page_kind == kind]
+    if not kind_pages:
+      continue
+    num_lines = sum(page.text.count('\n') + 1 for page in kind_pages)
+    num_bytes = sum(len(page.content) for page in kind_pages)
+    start = time.perf_counter()
+    for _ in range(repeat):
+      for page in kind_pages:
+        parse(page)
+    seconds = (time.perf_counter() - start) / repeat
+    results[kind] = {'pages': len(kind_pages), 'lines': num_lines, 'bytes': num_bytes,
+                     'seconds': seconds,
+                     'pages_per_s': len(kind_pages) / seconds,
+                     'lines_per_s': num_lines / seconds}
+  return results
+
+
+def lookup_latency(pages, repeat, workers):
+  """ Seconds per lookup_programs call for each institution with a recorded Phase I page, fetching
+      from the stub server. Returns the timings and the programs found for each institution.
+  """
+  from registered_programs import known_institutions, lookup_programs
+
+  # Phase I requests carry the numeric NYSED id; prefer the CUNY abbreviation when there is one.
+  by_nysed_id = {}
+  for inst, (institution_id, institution_name, is_cuny) in known_institutions.items():
+    if is_cuny or institution_id not in by_nysed_id:
+      by_nysed_id[institution_id] = inst
+  institutions = sorted(by_nysed_id[data['instid']] for kind, url, data, page in pages
+                        if kind == 'programs' and data.get('instid') in by_nysed_id)
+
+  results, found = {}, {}
+  for institution in institutions:
+    times = []
+    for _ in range(repeat):
+      shared_pages = {}
+      start = time.perf_counter()
+      programs = lookup_programs(institution, workers=workers, shared_pages=shared_pages)
+      times.append(time.perf_counter() - start)
+    found[institution] = programs
+    results[institution] = {'programs': len(programs),
+                            'variants': sum(len(p.variants) for p in programs.values()),
+                            'seconds_min': min(times),
+                            'seconds_median': statistics.median(times)}
+  return results, found
+
+
+def check_scratch_db(dbname):
+  """ Exit if dbname is the live database. """
+  if dbname == LIVE_DBNAME:
+    sys.exit(f'Refusing to seed {LIVE_DBNAME}: give --dsn for a scratch database.')
+
+
+def generate_html_time(found, dsn):
+  """ Re-create registered_programs in the scratch database, seed it with the scraped programs,
+      then time full and incremental runs of generate_html on the same connection.
+  """
+  import psycopg
+  from generate_html import generate_html
+  from registered_programs_db import replace_institution
+
+  with psycopg.connect(dsn) as conn:
+    # The dsn may leave the database name to PGDATABASE or the user name.
+    check_scratch_db(conn.info.dbname)
+    conn.execute('create table if not exists updates (table_name text primary key, '
+                 'update_date date)')
+    conn.execute(SCHEMA_FILE.read_text())
+    for institution, programs in found.items():
+      replace_institution(conn, institution, programs)
+    conn.commit()
+    start = time.perf_counter()
+    num_generated, total_rows = generate_html(full=True, conn=conn)
+    conn.commit()
+    full_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    generate_html(conn=conn)
+    conn.commit()
+    incremental_seconds = time.perf_counter() - start
+  return {'rows': total_rows, 'full_seconds': full_seconds,
+          'incremental_seconds': incremental_seconds}
+
+
+def compare(results, old_results, path=''):
+  """ Print new/old ratios for the numeric measurements the two results have in common. """
+  for key, value in results.items():
+    old_value = old_results.get(key) if isinstance(old_results, dict) else None
+    if isinstance(value, dict):
+      compare(value, old_value, f'{path}{key}.')
+    elif (isinstance(value, float) and isinstance(old_value, (int, float)) and old_value):
+      print(f'{path}{key:<40} {old_value:12.4g} → {value:12.4g}  ({value / old_value:6.2f}×)')
+
+
+def run(args):
+  if args.db:
+    # Checked now, rather than after the lookups have run.
+    from psycopg.conninfo import conninfo_to_dict
+    check_scratch_db(conninfo_to_dict(args.dsn).get('dbname'))
+  pages = list(fixture_pages(args.fixtures))
+  if not pages:
+    sys.exit(f'No recorded pages in {args.fixtures}')
+  try:
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                            text=True, cwd=Path(__file__).parent).stdout.strip()
+  except OSError:
+    commit = ''
+  results = {'commit': commit or 'unknown',
+             'date': datetime.now().isoformat(timespec='seconds'),
+             'python': platform.python_version(),
+             'repeat': args.repeat,
+             'workers': args.workers,
+             'latency_ms': args.latency}
+
+  results['parse'] = parse_throughput(pages, args.repeat)
+
+  with StubServer(args.fixtures, latency=args.latency / 1000) as server:
+    # Must be set before nysed_fetch is imported.
+    os.environ['NYSED_URL'] = os.environ['NYSED_WWW_URL'] = server.url
+    results['lookup_programs'], found = lookup_latency(pages, args.repeat, args.workers)
+    results['stub_server'] = {'requests': server.requests, 'misses': server.misses}
+
+  if args.db:
+    results['generate_html'] = generate_html_time(found, args.dsn)
+
+  output = Path(args.output or RESULTS_DIR / f'{results["commit"]}.json')
+  output.parent.mkdir(parents=True, exist_ok=True)
+  output.write_text(json.dumps(results, indent=2) + '\n')
+  print(f'Results saved to {output}', file=sys.stderr)
+
+  if args.compare:
+    compare(results, json.loads(Path(args.compare).read_text()))
+  else:
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the scrapers against recorded pages.')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  record_parser = subparsers.add_parser('record', help='record pages from the NYSED websites')
+  record_parser.add_argument('institutions', nargs='+', metavar='institution')
+  record_parser.add_argument('--workers', type=int, default=1)
+  record_parser.add_argument('--rate', type=float, default=None)
+
+  run_parser = subparsers.add_parser('run', help='run the benchmarks against recorded pages')
+  run_parser.add_argument('-r', '--repeat', type=int, default=5)
+  run_parser.add_argument('--workers', type=int, default=1)
+  run_parser.add_argument('--latency', type=float, default=0.0, metavar='MS',
+                          help='delay each stub server response by this many milliseconds')
+  run_parser.add_argument('--db', action='store_true', default=False,
+                          help='also seed a scratch database (see --dsn) and time generate_html')
+  run_parser.add_argument('--dsn', default=None, metavar='CONNINFO',
+                          help='connection string of the scratch database for --db '
+                               f'(required with --db; {LIVE_DBNAME} is refused)')
+  run_parser.add_argument('-o', '--output', default=None,
+                          help=f'results file (default {RESULTS_DIR.name}/COMMIT.json)')
+  run_parser.add_argument('--compare', default=None, metavar='RESULTS',
+                          help='show ratios to the measurements in an earlier results file')
+
+  for subparser in (record_parser, run_parser):
+    subparser.add_argument('-f', '--fixtures', default=DEFAULT_FIXTURE_DIR,
+                           help=f'fixture directory (default {DEFAULT_FIXTURE_DIR.name})')
+  args = parser.parse_args()
+  if args.command == 'run' and args.db and not args.dsn:
+    run_parser.error('--db requires --dsn')
+  if args.command == 'record':
+    record(args)
+  else:
+    run(args)
@@ -0,0 +1,163 @@
+""" On-disk checkpoints of an institution’s scrape, so an interrupted run can be resumed.
+
+    Each institution’s checkpoint is a JSON-lines file, appended to as the scrape progresses:
+      {"run": run_id, "phase_1": [program, ...]}
+                                    The run that wrote the checkpoint, and the programs and
+                                    variants found in Phase I.
+      {"phase_2": program}          One line for each program whose details have been parsed.
+      {"done": true}                The institution’s results have been saved.
+    A program is recorded as {"program_code", "unit_code", "formats", "variants"}, where each
+    variant is [award, hegis, institution, {field: value}] with the other Variant_Info fields that
+    have values.
+
+    A run is identified by its run_id, by default the date it started. Only a checkpoint written by
+    the same run is resumed: one left by an earlier run that failed is ignored, and replaced when
+    the institution is scraped again. A retry that may start after midnight is given its first
+    attempt’s run_id, so it continues from where that attempt stopped.
+
+    Resuming rebuilds the programs registry from the checkpoint (the Phase II version of each
+    program that has one, and the Phase I version of the rest) and reports which program codes are
+    complete, so Phase II can carry on with the others. A partial last line, left by a process that
+    was killed while writing it, is ignored.
+"""
+import json
+
+from datetime import date
+from pathlib import Path
+from registered_program import ProgramRegistry, RegisteredProgram, Variant_Info
+from typing import List, NamedTuple, Optional
+
+DEFAULT_CHECKPOINT_DIR = Path(__file__).parent / 'checkpoints'
+
+# Variant_Info fields that are set from the variant’s key, and so are not recorded separately.
+_KEY_FIELDS = ('award', 'hegis', 'institution')
+
+
+def default_run_id() -> str:
+  """ Today’s date, which identifies the run unless another run_id is given. """
+  return date.today().isoformat()
+
+
+class Restored(NamedTuple):
+  completed: List[str]    # Program codes whose Phase II details are complete, in Phase I order.
+  done: bool
+
+
+def program_record(program: RegisteredProgram) -> dict:
+  variants = []
+  for (award, hegis, institution), variant in program.variants.items():
+    fields = {field: variant[field] for field in Variant_Info.__slots__
+              if field not in _KEY_FIELDS and variant[field] is not None}
+    variants.append([award, hegis, institution, fields])
+  return {'program_code': program.program_code,
+          'unit_code': program.unit_code,
+          'formats': program.formats,
+          'variants': variants}
+
+
+def restore_program(programs: ProgramRegistry, record: dict) -> RegisteredProgram:
+  program = programs.program(record['program_code'], record['unit_code'], record['formats'])
+  for award, hegis, institution, fields in record['variants']:
+    program.new_variant(award, hegis, institution, **fields)
+  return program
+
+
+# class Checkpoint
+# -------------------------------------------------------------------------------------------------
+class Checkpoint(object):
+  """ The checkpoint file for one institution.
+  """
+
+  def __init__(self, institution: str, checkpoint_dir=DEFAULT_CHECKPOINT_DIR,
+               run_id: Optional[str] = None):
+    self.path = Path(checkpoint_dir, f'{institution}.jsonl')
+    self.run_id = run_id or default_run_id()
+    self._file = None
+
+  def _append(self, entry: dict):
+    self._file.write(json.dumps(entry) + '\n')
+    self._file.flush()
+
+  def start(self, programs: ProgramRegistry):
+    """ Begin a new checkpoint with the Phase I programs, replacing any earlier one.
+    """
+    self.close()
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    self._file = open(self.path, 'w', encoding='utf-8')
+    self._append({'run': self.run_id,
+                  'phase_1': [program_record(program) for program in programs.values()]})
+
+  def resume(self):
+    """ Continue appending to an existing checkpoint, after dropping any partial last line.
+    """
+    self.close()
+    with open(self.path, 'rb+') as checkpoint_file:
+      content = checkpoint_file.read()
+      checkpoint_file.truncate(content.rfind(b'\n') + 1)
+    self._file = open(self.path, 'a', encoding='utf-8')
+
+  def program_done(self, program: RegisteredProgram):
+    self._append({'phase_2': program_record(program)})
+
+  def finish(self):
+    self._append({'done': True})
+    self.close()
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def remove(self):
+    self.close()
+    self.path.unlink(missing_ok=True)
+
+  def _entries(self) -> List[dict]:
+    """ The checkpoint’s entries, up to any partial line, or an empty list if there is no
+        checkpoint written by this run.
+    """
+    try:
+      lines = self.path.read_text(encoding='utf-8').splitlines()
+    except FileNotFoundError:
+      return []
+    entries = []
+    for line in lines:
+      try:
+        entries.append(json.loads(line))
+      except ValueError:
+        break
+    if not entries or entries[0].get('run') != self.run_id:
+      return []
+    return entries
+
+  def is_done(self) -> bool:
+    """ Whether the checkpoint records that this run saved the institution’s results.
+    """
+    entries = self._entries()
+    return bool(entries) and entries[-1] == {'done': True}
+
+  def load(self, programs: ProgramRegistry) -> Optional[Restored]:
+    """ Add the programs as of the checkpoint to the (empty) registry. Returns None, and adds
+        nothing, if there is no usable checkpoint from this run.
+    """
+    phase_1 = None
+    phase_2 = {}
+    done = False
+    for entry in self._entries():
+      if 'phase_1' in entry:
+        phase_1 = entry['phase_1']
+      elif 'phase_2' in entry:
+        phase_2[entry['phase_2']['program_code']] = entry['phase_2']
+      elif entry.get('done'):
+        done = True
+    if phase_1 is None:
+      return None
+
+    completed = []
+    for record in phase_1:
+      program_code = record['program_code']
+      if program_code in phase_2:
+        record = phase_2[program_code]
+        completed.append(program_code)
+      restore_program(programs, record)
+    return Restored(completed, done)
@@ -1,21 +1,54 @@
 """ DB lookup of CIP code info from database.
+
+    The cuny_cip_code_tbl table is read the first time a code is looked up, not when the module is
+    imported. Its codes go into a character trie, so the description for a code is that of its
+    longest prefix in the table, found in one walk down the trie. Results are memoized.
 """
 
 import psycopg
+
+from functools import lru_cache
 from psycopg.rows import namedtuple_row
+from typing import Dict, Iterable, Optional
+
+# Each trie node is a dict of child nodes keyed by character; the key None holds the description
+# for the code that ends at that node, if there is one.
+_trie: Optional[dict] = None
+
 
-# Module initialization
-with psycopg.connect('dbname=cuny_curriculum') as conn:
-  with conn.cursor(row_factory=namedtuple_row) as cursor:
-    cursor.execute('select cip_code, long_descr as cip_title from cuny_cip_code_tbl')
-    _cip_codes = {cip.cip_code: cip.cip_title for cip in cursor.fetchall()}
+def _load_trie() -> dict:
+  """ Build the trie from the database, the first time it is needed.
+  """
+  global _trie
+  if _trie is None:
+    trie: dict = {}
+    with psycopg.connect('dbname=cuny_curriculum') as conn:
+      with conn.cursor(row_factory=namedtuple_row) as cursor:
+        cursor.execute('select cip_code, long_descr as cip_title from cuny_cip_code_tbl')
+        for cip in cursor:
+          node = trie
+          for ch in cip.cip_code:
+            node = node.setdefault(ch, {})
+          node[None] = cip.cip_title
+    _trie = trie
+  return _trie
 
 
+@lru_cache(maxsize=None)
 def cip_codes(cip_code: str) -> str:
   """ API for accessing CIP codes.
   """
-  while cip_code != '' and cip_code not in _cip_codes.keys():
-    cip_code = cip_code[:-1]
-  if cip_code != '':
-    return _cip_codes[cip_code]
-  return 'Unknown'
+  node = _load_trie()
+  description = 'Unknown'
+  for ch in cip_code:
+    node = node.get(ch)
+    if node is None:
+      break
+    description = node.get(None, description)
+  return description
+
+
+def cip_descriptions(codes: Iterable[str]) -> Dict[str, str]:
+  """ Batch API: the description for each of a collection of CIP codes.
+  """
+  return {cip_code: cip_codes(cip_code) for cip_code in set(codes)}
@@ -0,0 +1,182 @@
+""" Parse an IRPSL3 program details page from the NYSED website into structured records.
+
+    The details page is a PRE block inside an un-closed H4, and is processed as lines of text:
+      * A program line (program code, title, HEGIS, award, institution) followed by optional
+        multi-award (M/A) and multi-institution (M/I) lines. These determine the program’s
+        variants. An M/I line may instead say that a partner institution is NOT-GRANTING the award.
+      * One or more FOR AWARD lines, each followed by detail lines for that award: certificate or
+        license, financial aid eligibility, professional accreditation, and registration dates.
+
+    Each line is classified once, by its first token, using precompiled patterns. Detail lines are
+    reported only after a FOR AWARD line has been seen, because before then there are no variants
+    for them to apply to.
+
+    Line breaks: str.splitlines() also splits on \\v, \\f, \\x1c, \\x1d, \\x1e, \\x85, \\u2028, and
+    \\u2029. A page with a stray 0x1e in the middle of a string of blanks (program code 31441 at CSI)
+    broke the program line parse that way, so those characters are deleted from the page and lines
+    are split only at \\n, \\r\\n, and \\r.
+"""
+import re
+
+from typing import Iterator, NamedTuple, Tuple, Union
+
+# Characters str.splitlines() treats as line boundaries, other than \n and \r.
+_stray_separators = re.compile('[\v\f\x1c\x1d\x1e\x85\u2028\u2029]')
+
+# Lines worth looking at contain one of these; everything else on the page is ignored. The page is
+# searched as a whole, so lines without a match are never split out.
+_relevant = re.compile(r'FOR AWARD|PROGRAM|CERTIFICATE|M/A|M/I|^[^\S\n]+\d{5}[^\S\n]', re.M)
+
+_program_line = re.compile(r'\s*(\d+|M/A)\s+(.+)(\d{4}\.\d{2})\s+(\S+\s?\S*)\s+(.+)')
+_not_granting = re.compile(r'NOT-GRANTING\s+(.+)')
+_multi_institution = re.compile(r'(\d{4}.\d{2})\s+(\S+\s?\S*)\s+(.*)')
+_for_award = re.compile(r'\s*FOR AWARD\s*--(.*)')
+_whitespace = re.compile(r'\s+')
+_financial = re.compile(r'(YES|NO).+(YES|NO).+(YES|NO)')
+_dates = re.compile(r'DATE:\s+(\S+).+ACTION:\s+(\S+)')
+
+
+class ProgramLine(NamedTuple):
+  """ Program code line, or a multi-award (M/A) line when code is 'M/A'. The title is as it
+      appears on the page.
+  """
+  code: str
+  title: str
+  hegis: str
+  award: str
+  institution: str
+
+
+class MultiInstitution(NamedTuple):
+  hegis: str
+  award: str
+  institution: str
+
+
+class NotGranting(NamedTuple):
+  """ M/I line saying an institution does not grant the award of the preceding line. """
+  institution: str
+
+
+class ForAward(NamedTuple):
+  award: str
+
+
+class Certificate(NamedTuple):
+  """ Certificate or license info; empty if the page says NONE. """
+  text: str
+
+
+class Financial(NamedTuple):
+  tap: str
+  apts: str
+  vvta: str
+
+
+class Accreditation(NamedTuple):
+  text: str
+
+
+class Dates(NamedTuple):
+  first_registration: str
+  last_action: str
+
+
+Record = Union[ProgramLine, MultiInstitution, NotGranting, ForAward,
+               Certificate, Financial, Accreditation, Dates]
+
+
+class DetailParseError(ValueError):
+  """ A relevant line that does not have the expected format. """
+  def __init__(self, kind: str, line: str):
+    super().__init__(f'Unable to parse {kind} line:\n{line}')
+    self.kind = kind
+    self.line = line
+
+
+# detail_lines()
+# -------------------------------------------------------------------------------------------------
+def detail_lines(page: str) -> Iterator[str]:
+  """ Yield the relevant lines of a details page, stripped of leading markup and whitespace.
+  """
+  if _stray_separators.search(page):
+    page = _stray_separators.sub('', page)
+  if '\r' in page:
+    page = page.replace('\r\n', '\n').replace('\r', '\n')
+  search, find, rfind = _relevant.search, page.find, page.rfind
+  matches = search(page)
+  while matches is not None:
+    start = rfind('\n', 0, matches.start()) + 1
+    end = find('\n', matches.start())
+    if end < 0:
+      end = len(page)
+    line = page[start:end]
+    if '<' in line:
+      line = line.replace('<H4><PRE>', '')
+    yield line.strip()
+    matches = search(page, end)
+
+
+# parse_detail_page()
+# -------------------------------------------------------------------------------------------------
+def parse_detail_page(page: str) -> Iterator[Tuple[str, Record]]:
+  """ Yield (line, record) for each line of a details page that carries program information.
+      Raises DetailParseError for a line that is recognized but cannot be parsed.
+  """
+  in_award = False
+  for line in detail_lines(page):
+    tokens = line.split(None, 2)
+    if not tokens:
+      continue
+    token = tokens[0]
+
+    if token.isdecimal() or token == 'M/A':
+      matches = _program_line.match(line)
+      if matches is None:
+        raise DetailParseError('program code', line)
+      code, title, hegis, award, institution = matches.groups()
+      yield line, ProgramLine(code, title, hegis, award.strip(), institution)
+
+    elif token == 'M/I':
+      if 'NOT-GRANTING' in line:
+        matches = _not_granting.search(line)
+        if matches is None:
+          raise DetailParseError('M/I', line)
+        yield line, NotGranting(matches.group(1).strip())
+      else:
+        matches = _multi_institution.search(line)
+        if matches is None:
+          raise DetailParseError('M/I', line)
+        hegis, award, institution = matches.groups()
+        yield line, MultiInstitution(hegis, award.strip(), institution.strip())
+
+    elif token == 'FOR':
+      matches = _for_award.match(line)
+      if matches is None:
+        raise DetailParseError('for award', line)
+      in_award = True
+      yield line, ForAward(matches.group(1).strip())
+
+    elif not in_award:
+      continue
+
+    elif token.startswith('CERTIFICATE'):
+      cert_info = _whitespace.sub(' ', line.split(':')[1].strip())
+      if cert_info.startswith('NONE'):
+        cert_info = ''
+      yield line, Certificate(cert_info)
+
+    elif token == 'PROGRAM' and len(tokens) > 1:
+      kind = tokens[1]
+      if kind == 'FINANCIAL':
+        matches = _financial.search(line)
+        if matches is None:
+          raise DetailParseError('eligibility', line)
+        yield line, Financial(*matches.groups())
+      elif kind == 'PROFESSIONAL':
+        yield line, Accreditation(line.split(':')[1].strip())
+      elif kind == 'FIRST':
+        matches = _dates.search(line)
+        if matches is None:
+          raise DetailParseError('registration dates', line)
+        yield line, Dates(*matches.groups())
@@ -1,17 +1,33 @@
 #! /usr/local/bin/python3
-"""Generate HTML/CSV files for registered_programs page."""
+"""Generate HTML/CSV files for registered_programs page.
+
+By default, only rows whose inputs have changed since the last run are regenerated: each row’s
+html_fingerprint column holds a hash of everything its html and csv values were built from (the
+row itself, plus the cuny_programs, requirement_blocks, hegis_codes, CIP code, and institution
+information used for it). Use --full to regenerate every row.
+
+The html and csv values of the whole table are then written to ready-to-serve files (see
+static_files.py), unless --no_static is given.
+"""
+import argparse
+import hashlib
 import json
 import psycopg
 import sys
 
-from cip_codes import cip_codes
-from collections import namedtuple
+from cip_codes import cip_descriptions
+from collections import defaultdict, namedtuple
 from datetime import datetime, date
+from metrics import CountingCursor, metrics, save_on_exit
 from pathlib import Path
 from psycopg.rows import namedtuple_row
+from static_files import DEFAULT_STATIC_DIR, write_static_files
 
 DEBUG = False
 
+# Number of rows’ html and csv values to write back to registered_programs at a time.
+BATCH_SIZE = 2000
+
 
 # fix_title()
 # -------------------------------------------------------------------------------------------------
@@ -50,14 +66,58 @@ def andor_list(items, andor='and'):
   return return_str
 
 
+# write_back()
+# -------------------------------------------------------------------------------------------------
+def write_back(cursor, updates):
+  """Set the html and csv columns of registered_programs from a batch of updates.
+
+  updates maps (target_institution, program_code, award) to (html, csv, html_fingerprint). The
+  batch is loaded with COPY into a temporary table and applied with a single UPDATE ... FROM, so no
+  SQL is ever built from the cell contents.
+  """
+  with metrics.phase('write_back'):
+    metrics.count('rows_written', len(updates))
+    cursor.execute("""
+                   create temporary table if not exists html_csv_updates (
+                     target_institution text,
+                     program_code text,
+                     award text,
+                     html text,
+                     csv text,
+                     html_fingerprint text
+                   ) on commit drop;
+                   truncate html_csv_updates;
+                   """)
+    with cursor.copy('copy html_csv_updates from stdin') as copy:
+      for key, values in updates.items():
+        copy.write_row(key + values)
+    cursor.execute("""
+                   update registered_programs r
+                      set html = u.html,
+                          csv = u.csv,
+                          html_fingerprint = u.html_fingerprint
+                     from html_csv_updates u
+                    where r.target_institution = u.target_institution
+                      and r.program_code = u.program_code
+                      and r.award = u.award
+                   """)
+
+
 # generate_html()
 # -------------------------------------------------------------------------------------------------
-def generate_html():
-  """Generate the html for registered programs rows."""
-  with psycopg.connect('dbname=cuny_curriculum') as conn:
-    with conn.cursor(row_factory=namedtuple_row) as cursor:
-      with conn.cursor(row_factory=namedtuple_row) as inner_cursor:
+def generate_html(full=False, conn=None):
+  """Generate the html for registered programs rows whose inputs have changed, or for all rows if
+  full is True. Returns the number of rows regenerated and the total number of rows. Uses conn if
+  one is given, leaving the commit to the caller; otherwise opens (and commits) a connection.
+  """
+  if conn is None:
+    with psycopg.connect('dbname=cuny_curriculum', cursor_factory=CountingCursor) as conn:
+      return generate_html(full=full, conn=conn)
 
+  with conn.cursor(row_factory=namedtuple_row) as cursor:
+    with conn.cursor(row_factory=namedtuple_row) as inner_cursor:
+
+      with metrics.phase('prefetch'):
         # Cache HEGIS codes table
         cursor.execute('select hegis_code, description from hegis_codes')
         hegis_codes = {row.hegis_code: row.description for row in cursor}
@@ -67,8 +127,10 @@ def generate_html():
         known_institutions = dict()
         cursor.execute("select * from nys_institutions")
         for row in cursor:
-          # id='bar', institution_id='330500', institution_name='CUNY BARUCH COLLEGE', is_cuny=True
-          # id='270300', institution_id='270300', institution_name='ADIRONDACK COMM COLL', is_cuny=False
+          # id='bar', institution_id='330500', institution_name='CUNY BARUCH COLLEGE',
+          #   is_cuny=True
+          # id='270300', institution_id='270300', institution_name='ADIRONDACK COMM COLL',
+          #   is_cuny=False
           known_institutions[row.id] = (row.institution_id, row.institution_name, row.is_cuny)
 
         # Get CUNYfirst institution codes for the short names in known_institutions.
@@ -77,6 +139,24 @@ def generate_html():
         for row in cursor:
           short_names[row.code.lower()[0:3]] = row.prompt
 
+        # Active CUNY programs (plans), grouped by NYS program code.
+        cuny_programs = defaultdict(list)
+        cursor.execute("select * from cuny_programs where program_status = 'A'")
+        for plan in cursor:
+          cuny_programs[str(plan.nys_program_code)].append(plan)
+
+        # Requirement ids of current MAJOR requirement blocks, keyed by (institution,
+        # block_value), where institution is the lowercase three-letter code (QNS01 => qns).
+        major_blocks = defaultdict(list)
+        cursor.execute("""
+                       select institution, block_value, requirement_id
+                         from requirement_blocks
+                        where block_type = 'MAJOR'
+                          and period_stop ~* '^9'
+                       """)
+        for block in cursor:
+          major_blocks[(block.institution.lower()[0:3], block.block_value)].append(block)
+
         # Generate the HTML and CSV values for each row of the respective tables, and save them in
         # the registered_programs table as html and csv column data.
         cursor.execute("""
@@ -94,16 +174,27 @@ def generate_html():
                               tap, apts, vvta,
                               target_institution,
                               institution_id as sed_code,
-                              is_variant
+                              is_variant,
+                              html_fingerprint
                        from registered_programs, nys_institutions
                        where nys_institutions.id ~* registered_programs.institution
                        order by title, program_code
                        """)
 
+        # Rows that share a (target_institution, program_code, award) key are all updated with the
+        # values generated for the last of them, so only that one needs to be generated.
+        rows = cursor.fetchall()
+        last_row_numbers = {(row.target_institution, row.program_code, row.award): row_number
+                            for row_number, row in enumerate(rows, 1)}
+
+      with metrics.phase('generate'):
         # Parallel structures for the HTML and CSV cells
-        total_rows = cursor.rowcount
+        total_rows = len(rows)
+        metrics.count('rows_read', total_rows)
         row_number = 0
-        for row in cursor:
+        num_generated = 0
+        updates = dict()
+        for row in rows:
           row_number += 1
           if DEBUG:
             # Progress to stdout
@@ -111,6 +202,26 @@ def generate_html():
             # Debug info to stderr
             print(row, file=sys.stderr)
 
+          key = (row.target_institution, row.program_code, row.award)
+          if last_row_numbers[key] != row_number:
+            continue
+
+          # Skip the row if nothing it depends on has changed.
+          plans = cuny_programs.get(row.program_code, [])
+          inputs = (row[:-1],
+                    known_institutions.get(row.institution.lower()),
+                    hegis_codes.get(row.hegis),
+                    [tuple(plan) for plan in plans],
+                    [short_names.get(plan.institution.lower()[0:3]) for plan in plans],
+                    [major_blocks.get((row.institution.lower(), plan.academic_plan))
+                     for plan in plans],
+                    sorted(cip_descriptions(plan.cip_code for plan in plans).items()))
+          fingerprint = hashlib.sha1(repr(inputs).encode()).hexdigest()
+          if not full and fingerprint == row.html_fingerprint:
+            continue
+          num_generated += 1
+          metrics.count('rows_generated')
+
           # Pick out two parameters for later use
           if row.is_variant:
             class_str = ' class="variant"'
@@ -121,7 +232,10 @@ def generate_html():
           html_values = list(row)
           csv_values = list(row)
 
-          # Get rid of the two parameter values that won't be displayed.
+          # Get rid of the parameter values that won't be displayed.
+          #   Don’t display the fingerprint
+          html_values.pop()
+          csv_values.pop()
           #   Don’t display is_variant value: it is indicated by the row’s class.
           html_values.pop()
           csv_values.pop()
@@ -132,13 +246,14 @@ def generate_html():
           html_values.pop()
           csv_values.pop()
 
-          # If the institution column is a numeric string, it’s a non-CUNY partner school, but the
-          # name is available in the known_institutions dict.
+          # If the institution column is a numeric string, it’s a non-CUNY partner school, but
+          # the name is available in the known_institutions dict.
           if html_values[2].isdecimal():
             html_values[2] = fix_title(known_institutions[html_values[2]][1])
             csv_values[2] = html_values[2]
           # Add hover for sed_code
-          html_values[2] = f'<span title="NYSED Institution ID {sed_code}">{html_values[2]}</span>'
+          html_values[2] = (f'<span title="NYSED Institution ID {sed_code}">'
+                            f'{html_values[2]}</span>')
 
           # Add title with hegis code description to hegis_code column
           try:
@@ -151,14 +266,11 @@ def generate_html():
           csv_values[5] = f'{csv_values[5]} ({description})'
 
           # Insert list of all CUNY programs (plans) for this program code
-          inner_cursor.execute("""select * from cuny_programs
-                                 where nys_program_code = %s
-                                 and program_status = 'A'""", (html_values[0],))
+          plans = cuny_programs.get(html_values[0], [])
           cuny_cell_html_content = ''
           cuny_cell_csv_content = ''
           cip_set = set()
-          if inner_cursor.rowcount > 0:
-            plans = inner_cursor.fetchall()
+          if len(plans) > 0:
             # There is just one program and description per college, but the program may be shared
             # among multiple departments at a college.
             Program_Info = namedtuple('Program_Info', 'program program_title departments')
@@ -197,20 +309,14 @@ def generate_html():
                                          f'<br>{program_title}')
               cuny_cell_csv_content += f'{inst_str}{program} ({departments_str})\n{program_title}'
 
-              # If there is a single dgw requirement block for the plan, link to it
+              # If there is a single dgw requirement block for the plan, link to it. (Non-CUNY
+              # institutions have numeric ids, and no requirement blocks.)
               institution = row.institution
-              inner_cursor.execute("""
-                                 select *
-                                   from requirement_blocks
-                                  where institution ~* %s
-                                    and block_type = 'MAJOR'
-                                    and block_value = %s
-                                    and period_stop ~* '^9'
-                                 """, (institution, plan.academic_plan))
+              blocks = major_blocks.get((institution.lower(), plan.academic_plan), [])
               # Can only link to a single RA for a major from here. Log multiple-RA instances.
-              if inner_cursor.rowcount > 0:
-                if inner_cursor.rowcount == 1:
-                  plan_row = inner_cursor.fetchone()
+              if len(blocks) > 0:
+                if len(blocks) == 1:
+                  plan_row = blocks[0]
                   cuny_cell_html_content += (f'<br><a href="/requirements/?institution='
                                              f'{institution.upper() + "01"}'
                                              f'&requirement_id={plan_row.requirement_id}">'
@@ -227,47 +333,58 @@ def generate_html():
                   home_dir = Path.home()
                   log_file_path = Path(home_dir, 'Projects/cuny_programs/registered_programs.log')
                   with log_file_path.open(mode='a') as log_file:
-                    print(f'{date.today()} Found {inner_cursor.rowcount} current RA’s for '
+                    print(f'{date.today()} Found {len(blocks)} current RA’s for '
                           f'{institution}, {plan.academic_plan}', file=log_file)
               if show_institution:
                 cuny_cell_html_content += '<br>'
                 cuny_cell_csv_content += '\n'
-          cip_html_cell = [f'<span title="{cip_codes(cip)}">{cip}</span>'
+          cip_titles = cip_descriptions(cip_set)
+          cip_html_cell = [f'<span title="{cip_titles[cip]}">{cip}</span>'
                            for cip in sorted(cip_set)]
-          cip_csv_cell = [f'{cip} ({cip_codes(cip).strip(".")})' for cip in sorted(cip_set)]
+          cip_csv_cell = [f'{cip} ({cip_titles[cip].strip(".")})' for cip in sorted(cip_set)]
           html_values.insert(7, '<br>'.join(cip_html_cell))
           csv_values.insert(7, ', '.join(cip_csv_cell))
           html_values.insert(8, cuny_cell_html_content)
           csv_values.insert(8, cuny_cell_csv_content)
 
-          html_cells = ''.join([f'<td>{value}</td>' for value in html_values]).replace("\'", "’")
+          html_cells = (''.join([f'<td>{value}</td>' for value in html_values])
+                        .replace("\'", "’"))
           if DEBUG:
             print(f'  {row.award}', file=sys.stderr)
             print(f'  {csv_values}', file=sys.stderr)
             print(f'  {html_values}', file=sys.stderr)
-          inner_cursor.execute(f"""update registered_programs
-                                      set html='<tr{class_str}>{html_cells}</tr>'
-                                    where target_institution = %s
-                                      and program_code = %s
-                                      and award = %s
-                          """, (row.target_institution, row.program_code, row.award))
-
-          inner_cursor.execute("""update registered_programs
-                                      set csv= %s
-                                    where target_institution = %s
-                                      and program_code = %s
-                                      and award = %s
-                           """, (json.dumps(csv_values),
-                                 row.target_institution,
-                                 row.program_code,
-                                 row.award))
+          updates[key] = (f'<tr{class_str}>{html_cells}</tr>', json.dumps(csv_values),
+                          fingerprint)
+          if len(updates) >= BATCH_SIZE:
+            write_back(inner_cursor, updates)
+            updates.clear()
+
+        if len(updates) > 0:
+          write_back(inner_cursor, updates)
+  return num_generated, total_rows
 
 
 if __name__ == '__main__':
-  """ Command line interface: any argument turns on debugging/progress
+  """ Command line interface
   """
-  if len(sys.argv) > 1:
-    DEBUG = True
+  parser = argparse.ArgumentParser(description='Generate html and csv values for registered '
+                                               'programs.')
+  parser.add_argument('-d', '--debug', action='store_true', default=False,
+                      help='show progress and debugging info')
+  parser.add_argument('--full', action='store_true', default=False,
+                      help='regenerate all rows, not just the ones whose inputs have changed')
+  parser.add_argument('--static_dir', default=DEFAULT_STATIC_DIR, metavar='DIR',
+                      help=f'where to write static files (default dir {DEFAULT_STATIC_DIR.name})')
+  parser.add_argument('--no_static', action='store_true', default=False,
+                      help='do not write the static files')
+  args = parser.parse_args()
+  DEBUG = args.debug
+  save_on_exit(__file__)
   start = datetime.now()
-  generate_html()
+  num_generated, total_rows = generate_html(full=args.full)
+  print(f'  {num_generated:,} of {total_rows:,} rows regenerated')
+  if not args.no_static:
+    with psycopg.connect('dbname=cuny_curriculum', cursor_factory=CountingCursor) as conn:
+      num_files = write_static_files(conn, args.static_dir)
+    print(f'  {num_files:,} static files updated in {args.static_dir}')
   print(f'  {(datetime.now() - start).total_seconds():0.1f} seconds')
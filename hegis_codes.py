@@ -1,68 +1,130 @@
 #! /usr/local/bin/python3
-"""Scrape HEGIS codes from NYS Department of Education website."""
+"""Scrape HEGIS codes from NYS Department of Education website.
+
+The page is parsed with lxml, and the hegis_areas and hegis_codes tables are rebuilt with one COPY
+each, in a single transaction.
+"""
 
 import psycopg
 import requests
 import socket
 
 from datetime import datetime
+from lxml.html import document_fromstring
+from metrics import CountingCursor, metrics, save_on_exit
+from nysed_fetch import HEGIS_URL, fetch_page
 from psycopg.rows import namedtuple_row
 from sendemail import send_message
+from typing import Dict, List, NamedTuple, Tuple
+
+
+class HegisPageError(ValueError):
+  """ The HEGIS codes page does not have the expected structure.
+  """
+  pass
+
+
+class HegisArea(NamedTuple):
+  name: str
+  codes: List[Tuple[str, str]]    # (hegis_code, description)
+
+
+# parse_hegis_page()
+# -------------------------------------------------------------------------------------------------
+def parse_hegis_page(content: bytes) -> Tuple[List[HegisArea], datetime]:
+  """ Return the areas, with their codes, from the HEGIS codes page, and the date the page was last
+      changed.
+
+      Each area is a table whose first child is its caption and whose third child holds a row for
+      each code, with the code and its description in the first two cells.
+  """
+  html_document = document_fromstring(content)
+  areas = []
+  for table in html_document.iter('table'):
+    # Elements only, skipping comments.
+    children = table.xpath('./*')
+    if children[0].tag != 'caption':
+      raise HegisPageError(f'Table {len(areas) + 1} has no caption')
+    area_name = children[0].text_content().strip()
+    codes = []
+    for row in children[2].xpath('./*'):
+      if row.tag != 'tr':
+        raise HegisPageError(f'{row.tag} element among the rows of the {area_name} table')
+      cells = row.xpath('./*')
+      codes.append((cells[0].text_content().strip(), cells[1].text_content().strip()))
+    areas.append(HegisArea(area_name, codes))
+  # There are ten areas as of March 2020. If there are fewer than six consider it an error and do
+  # not continue.
+  if len(areas) < 6:
+    raise HegisPageError(f'Expected at least six tables; got {len(areas)}.')
 
-from AdvancedHTMLParser import AdvancedHTMLParser
-
-# Be sure the NYSED website is accessible before proceeding.
-try:
-  r = requests.get('http://nysed.gov/college-university-evaluation/'
-                   'new-york-state-taxonomy-academic-programs-hegis-codes').text
-except requests.exceptions.ConnectionError as err:
-  send_message([{'name': 'Christopher Vickery', 'email': 'cvickery@qc.cuny.edu'}],
-               {'name': 'Transfer App', 'email': 'cvickery@qc.cuny.edu'},
-               f'HEGIS Code Update Failed on {socket.gethostname()}',
-               f'<p>{err}</p>')
-  exit(f'HEGIS Code Update Failed on {socket.gethostname()}: <p>{err}</p>')
-
-parser = AdvancedHTMLParser()
-parser.parseStr(r)
-
-tables = parser.getElementsByTagName('table')
-# There are ten areas as of March 2020. If there are fewer than six consider it an error and do not
-# continue.
-if len(tables) < 6:
-  exit(f'hegis_codes.py: ERROR: Expected at least six tables; got {len(tables)}.')
-
-conn = psycopg.connect('dbname=cuny_curriculum')
-cursor = conn.cursor(row_factory=namedtuple_row)
-cursor.execute('drop table if exists hegis_areas, hegis_codes')
-cursor.execute("""
-                  create table hegis_areas (
-                    id serial primary key,
-                    hegis_area text);
-                  create table hegis_codes (
-                    hegis_code text primary key,
-                    area_id integer references hegis_areas,
-                    description text
-                  );
-               """)
-
-area_name = None
-area_id = -1
-for table in tables:
-  assert table.children[0].tagName == 'caption'
-  area_name = table.children[0].innerText.strip()
-  cursor.execute('insert into hegis_areas values(default, %s) returning id', (area_name, ))
-  area_id = cursor.fetchone()[0]
-  for row in table.children[2].children:
-    assert row.tagName == 'tr'
-    hegis_code = row.children[0].innerText.strip()
-    description = row.children[1].innerText.strip()
+  changes = html_document.find_class('pane-node-changed')
+  update_date = datetime.strptime(changes[0].xpath('./*')[1].text_content().strip(),
+                                  '%B %d, %Y - %I:%M%p')
+  return areas, update_date
+
+
+# update_hegis_codes()
+# -------------------------------------------------------------------------------------------------
+def update_hegis_codes(conn):
+  """ Rebuild the hegis_areas and hegis_codes tables from the NYSED website, and record the date
+      of the page in the updates table.
+  """
+  with metrics.phase('fetch'):
+    content = fetch_page(HEGIS_URL).content
+
+  with metrics.phase('parse'):
+    areas, update_date = parse_hegis_page(content)
+    # A code listed more than once keeps its first area and description.
+    codes: Dict[str, Tuple[int, str]] = dict()
+    for area_id, area in enumerate(areas, start=1):
+      for hegis_code, description in area.codes:
+        codes.setdefault(hegis_code, (area_id, description))
+      metrics.count('rows_parsed', len(area.codes))
+
+  with metrics.phase('db_write'), conn.transaction():
+    cursor = conn.cursor(row_factory=namedtuple_row)
+    cursor.execute('drop table if exists hegis_areas, hegis_codes')
     cursor.execute("""
-                      insert into hegis_codes values (%s, %s, %s)
-                      on conflict do nothing
-                   """, (hegis_code, area_id, description))
-
-changes = parser.getElementsByClassName('pane-node-changed')
-update_date = datetime.strptime(changes[0].children[1].innerText.strip(), '%B %d, %Y - %I:%M%p')
-cursor.execute(f"update updates set update_date = '{update_date}' where table_name = 'hegis_codes'")
-conn.commit()
-conn.close()
+                      create table hegis_areas (
+                        id serial primary key,
+                        hegis_area text);
+                      create table hegis_codes (
+                        hegis_code text primary key,
+                        area_id integer references hegis_areas,
+                        description text
+                      );
+                   """)
+
+    # Area ids are assigned here, in page order, as the serial column would have; the sequence is
+    # then moved past them.
+    with cursor.copy('copy hegis_areas (id, hegis_area) from stdin') as copy:
+      for area_id, area in enumerate(areas, start=1):
+        copy.write_row((area_id, area.name))
+    cursor.execute("select setval(pg_get_serial_sequence('hegis_areas', 'id'), %s)",
+                   (len(areas), ))
+    with cursor.copy('copy hegis_codes (hegis_code, area_id, description) from stdin') as copy:
+      for hegis_code, (area_id, description) in codes.items():
+        copy.write_row((hegis_code, area_id, description))
+    metrics.count('rows_written', len(areas) + len(codes))
+
+    cursor.execute("update updates set update_date = %s where table_name = 'hegis_codes'",
+                   (update_date, ))
+
+
+if __name__ == '__main__':
+  save_on_exit(__file__)
+  conn = psycopg.connect('dbname=cuny_curriculum', cursor_factory=CountingCursor)
+  try:
+    update_hegis_codes(conn)
+  except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+    # The NYSED website is not accessible.
+    send_message([{'name': 'Christopher Vickery', 'email': 'cvickery@qc.cuny.edu'}],
+                 {'name': 'Transfer App', 'email': 'cvickery@qc.cuny.edu'},
+                 f'HEGIS Code Update Failed on {socket.gethostname()}',
+                 f'<p>{err}</p>')
+    exit(f'HEGIS Code Update Failed on {socket.gethostname()}: <p>{err}</p>')
+  except HegisPageError as err:
+    exit(f'hegis_codes.py: ERROR: {err}')
+  finally:
+    conn.close()
@@ -0,0 +1,92 @@
+""" Resolve NYSED institution names to nys_institutions ids without scanning the whole table.
+
+    The scraper needs two kinds of lookup:
+      * Exact: a detail-page line names an institution exactly as nys_institutions spells it.
+      * Substring: a Phase I H4 element mentions the institution somewhere inside a longer string.
+
+    Both used to be linear scans of known_institutions. An InstitutionIndex is built once from the
+    known_institutions dict: a reverse dict for exact names, and an Aho-Corasick automaton that
+    finds every institution name occurring in a string in one pass over that string.
+
+    When more than one id matches, the answer is the one that comes first in known_institutions,
+    which is what the linear scans returned. (CUNY colleges are listed both by their three-letter
+    id and by their numeric NYSED id; the three-letter id comes first.)
+"""
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+
+# class InstitutionIndex
+# -------------------------------------------------------------------------------------------------
+class InstitutionIndex(object):
+  """ Exact-name and substring lookups over a known_institutions dict, which maps ids to
+      (institution_id, institution_name, is_cuny) tuples.
+  """
+
+  def __init__(self, known_institutions: Dict[str, Tuple]):
+    self._ids: List[str] = list(known_institutions.keys())
+    self._by_name: Dict[str, List[str]] = dict()
+    for inst in self._ids:
+      self._by_name.setdefault(known_institutions[inst][1], []).append(inst)
+
+    # Aho-Corasick automaton. For each node: its goto transitions, its failure link, and the lowest
+    # rank (position in _ids) of any name that ends at this node or at one of its proper suffixes.
+    self._goto: List[Dict[str, int]] = [dict()]
+    self._fail: List[int] = [0]
+    self._rank: List[Optional[int]] = [None]
+    for rank, inst in enumerate(self._ids):
+      name = known_institutions[inst][1]
+      if not name:
+        continue
+      node = 0
+      for ch in name:
+        next_node = self._goto[node].get(ch)
+        if next_node is None:
+          next_node = len(self._goto)
+          self._goto.append(dict())
+          self._fail.append(0)
+          self._rank.append(None)
+          self._goto[node][ch] = next_node
+        node = next_node
+      if self._rank[node] is None:
+        self._rank[node] = rank
+
+    # Breadth-first, so each node’s failure target is finished before the node itself.
+    queue = deque(self._goto[0].values())
+    while queue:
+      node = queue.popleft()
+      for ch, child in self._goto[node].items():
+        queue.append(child)
+        fail = self._fail[node]
+        while fail and ch not in self._goto[fail]:
+          fail = self._fail[fail]
+        self._fail[child] = self._goto[fail].get(ch, 0)
+        fail_rank = self._rank[self._fail[child]]
+        if fail_rank is not None and (self._rank[child] is None or fail_rank < self._rank[child]):
+          self._rank[child] = fail_rank
+
+  def exact(self, name: str) -> Optional[str]:
+    """ Id of the institution with exactly this name, or None.
+    """
+    ids = self._by_name.get(name)
+    return ids[0] if ids else None
+
+  def all_named(self, name: str) -> List[str]:
+    """ Ids of all institutions with exactly this name.
+    """
+    return self._by_name.get(name, [])
+
+  def find_in(self, text: str) -> Optional[str]:
+    """ Id of the institution whose name occurs in text, or None.
+    """
+    goto, fail, ranks = self._goto, self._fail, self._rank
+    node = 0
+    found = None
+    for ch in text:
+      while node and ch not in goto[node]:
+        node = fail[node]
+      node = goto[node].get(ch, 0)
+      rank = ranks[node]
+      if rank is not None and (found is None or rank < found):
+        found = rank
+    return None if found is None else self._ids[found]
@@ -0,0 +1,199 @@
+""" Per-run metrics for the update scripts: where the time goes, and how much work was done.
+
+    Each script records into the module-level metrics object:
+      * wall time for each phase, using "with metrics.phase(name):". Phases can be nested; a nested
+        phase is reported under its full path, such as qns/phase_2. Each thread has its own stack
+        of phases; a worker thread can continue its caller’s, using metrics.within().
+      * each HTTP request, using metrics.record_request() (nysed_fetch.fetch_page() does this): a
+        latency histogram and byte count for each host and path, so a slow NYSED page type stands
+        out.
+      * counters such as rows_parsed and rows_written, using metrics.count(). Counts are kept for
+        the run as a whole and for the innermost phase in progress.
+      * DB round trips: connections opened with cursor_factory=CountingCursor count each execute,
+        executemany, and copy.
+
+    If METRICS_DIR is set in the environment, save_on_exit() writes the metrics as JSON to
+    METRICS_DIR/<script>_<start time>.json when the script exits, whether it succeeded or not.
+"""
+import atexit
+import json
+import os
+import psycopg
+import threading
+import time
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+# Upper bounds, in milliseconds, of the HTTP latency histogram buckets.
+LATENCY_BUCKETS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+def _quantile(values: List[float], q: float) -> float:
+  """ Nearest-rank quantile of sorted values. """
+  return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# class Metrics
+# -------------------------------------------------------------------------------------------------
+class Metrics(object):
+  """ Phase timings, HTTP latencies, and counters for one run of a script.
+  """
+
+  def __init__(self):
+    self.started = datetime.now()
+    self._start_time = time.perf_counter()
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self.phases: Dict[str, dict] = {}
+    self.counters: Counter = Counter()
+    self._latencies: Dict[str, List[float]] = defaultdict(list)
+    self._http_bytes: Counter = Counter()
+    self._http_errors: Counter = Counter()
+
+  @property
+  def _stack(self) -> List[str]:
+    """ This thread’s phases in progress, outermost first. """
+    try:
+      return self._local.stack
+    except AttributeError:
+      self._local.stack = []
+      return self._local.stack
+
+  def current_phases(self) -> Tuple[str, ...]:
+    """ The phases this thread has in progress, for handing on to worker threads. """
+    return tuple(self._stack)
+
+  @contextmanager
+  def within(self, phases: Tuple[str, ...]):
+    """ Count and time phases in the enclosed block as part of phases (from the thread that
+        started this one), rather than of this thread’s own.
+    """
+    saved = self._stack
+    self._local.stack = list(phases)
+    try:
+      yield
+    finally:
+      self._local.stack = saved
+
+  @contextmanager
+  def phase(self, name: str):
+    """ Time the enclosed block as a phase, nested inside any phase already in progress.
+    """
+    stack = self._stack
+    stack.append(name)
+    path = '/'.join(stack)
+    with self._lock:
+      stats = self.phases.setdefault(path, {'seconds': 0.0, 'count': 0, 'counters': Counter()})
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      with self._lock:
+        stats['seconds'] += time.perf_counter() - start
+        stats['count'] += 1
+      stack.pop()
+
+  def count(self, name: str, n: int = 1):
+    """ Add n to a counter, for the run and for the current phase.
+    """
+    stack = self._stack
+    with self._lock:
+      self.counters[name] += n
+      if stack:
+        self.phases['/'.join(stack)]['counters'][name] += n
+
+  def record_request(self, url: str, seconds: float, num_bytes: int, ok: bool = True):
+    """ Record one HTTP request’s latency and response size.
+    """
+    parts = urlsplit(url)
+    endpoint = parts.netloc + parts.path
+    with self._lock:
+      self._latencies[endpoint].append(seconds)
+      self._http_bytes[endpoint] += num_bytes
+      if not ok:
+        self._http_errors[endpoint] += 1
+    self.count('http_requests')
+    self.count('http_bytes', num_bytes)
+
+  def http_summary(self) -> Dict[str, dict]:
+    """ Request count, bytes, latency quantiles, and latency histogram for each endpoint.
+    """
+    summary = {}
+    with self._lock:
+      for endpoint, latencies in self._latencies.items():
+        latencies = sorted(latencies)
+        histogram = Counter()
+        for seconds in latencies:
+          ms = seconds * 1000
+          bucket = next((f'<={bound}ms' for bound in LATENCY_BUCKETS if ms <= bound),
+                        f'>{LATENCY_BUCKETS[-1]}ms')
+          histogram[bucket] += 1
+        summary[endpoint] = {
+            'requests': len(latencies),
+            'errors': self._http_errors[endpoint],
+            'bytes': self._http_bytes[endpoint],
+            'seconds_total': sum(latencies),
+            'seconds_p50': _quantile(latencies, 0.5),
+            'seconds_p90': _quantile(latencies, 0.9),
+            'seconds_p99': _quantile(latencies, 0.99),
+            'seconds_max': latencies[-1],
+            'histogram': {bucket: histogram[bucket]
+                          for bucket in [f'<={bound}ms' for bound in LATENCY_BUCKETS]
+                          + [f'>{LATENCY_BUCKETS[-1]}ms'] if histogram[bucket]}}
+    return summary
+
+  def as_dict(self, script: Optional[str] = None) -> dict:
+    with self._lock:
+      phases = {path: {'seconds': stats['seconds'], 'count': stats['count'],
+                       'counters': dict(stats['counters'])}
+                for path, stats in self.phases.items()}
+      counters = dict(self.counters)
+    return {'script': script,
+            'host': os.uname().nodename,
+            'started': self.started.isoformat(timespec='seconds'),
+            'seconds': time.perf_counter() - self._start_time,
+            'phases': phases,
+            'counters': counters,
+            'http': self.http_summary()}
+
+  def save(self, path, script: Optional[str] = None):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(self.as_dict(script), indent=2) + '\n')
+
+
+metrics = Metrics()
+
+
+def save_on_exit(script: str):
+  """ If METRICS_DIR is set, write this run’s metrics there when the script exits.
+  """
+  metrics_dir = os.environ.get('METRICS_DIR')
+  if metrics_dir:
+    script = Path(script).stem
+    path = Path(metrics_dir, f'{script}_{metrics.started:%Y-%m-%d_%H%M%S}.json')
+    atexit.register(metrics.save, path, script)
+
+
+# class CountingCursor
+# -------------------------------------------------------------------------------------------------
+class CountingCursor(psycopg.Cursor):
+  """ Cursor that counts the statements it sends to the server as db_round_trips.
+  """
+
+  def execute(self, query, params=None, **kwargs):
+    metrics.count('db_round_trips')
+    return super().execute(query, params, **kwargs)
+
+  def executemany(self, query, params_seq, **kwargs):
+    metrics.count('db_round_trips')
+    return super().executemany(query, params_seq, **kwargs)
+
+  def copy(self, statement, params=None, **kwargs):
+    metrics.count('db_round_trips')
+    return super().copy(statement, params, **kwargs)
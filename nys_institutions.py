@@ -1,14 +1,19 @@
 #! /usr/local/bin/python3
-"""Create table of all NYS institutions, with special attention to CUNY."""
+"""Create table of all NYS institutions, with special attention to CUNY.
 
+The table is rebuilt in a single transaction, and only if the list of institutions has changed.
+"""
+
+import hashlib
 import psycopg
 import requests
 
-from datetime import date
 from lxml.html import document_fromstring
+from metrics import CountingCursor, metrics, save_on_exit
+from nysed_fetch import INSTITUTIONS_URL, fetch_page
 from pathlib import Path
 from psycopg.rows import namedtuple_row
-from typing import Dict, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 """   Institutions that have academic programs registered with NYS Department of Education.
       Includes all known CUNY colleges plus other institutions that have M/I programs with a CUNY
@@ -70,42 +75,133 @@ headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:109.0
            'Sec-Fetch-Site': 'same-origin',
            'Sec-Fetch-User': '?1'}
 script_file = Path(__file__).name
-url = 'https://www2.nysed.gov/coms/rp090/IRPSL1/'
-response = requests.post(url, data={'Searches': "1"})
-if response.status_code == requests.codes.ok:
-  html_document = document_fromstring(response.content)
-  option_elements = [option.text_content() for option in html_document.cssselect('option')]
+
+
+class InstitutionsPageError(ValueError):
+  """ The institutions page is not what was expected.
+  """
+  pass
+
+
+# fetch_institutions()
+# -------------------------------------------------------------------------------------------------
+def fetch_institutions():
+  """ Return the text of each institution’s option element on the NYSED search page. Request
+      exceptions propagate to the caller.
+  """
+  url = INSTITUTIONS_URL
+  with metrics.phase('fetch'):
+    response = fetch_page(url, data={'Searches': "1"})
+  if response.status != requests.codes.ok:
+    raise InstitutionsPageError(f'{url} returned {response.status} status')
+  with metrics.phase('parse'):
+    html_document = document_fromstring(response.content)
+    option_elements = [option.text_content() for option in html_document.cssselect('option')]
+    metrics.count('rows_parsed', len(option_elements))
   if len(option_elements) < 400:
-    exit(f'{script_file}: ERROR: received {len(option_elements)} institutions from {url} '
-         f'(expected 400+).')
-else:
-  exit(f'{script_file}: ERROR: {url} returned {response.status_code} status')
-
-with psycopg.connect('dbname=cuny_curriculum') as conn:
-  with conn.cursor(row_factory=namedtuple_row) as cursor:
-    print('Creating nys_institutions table')
-    cursor.execute("""
-    drop table if exists nys_institutions;
-    create table nys_institutions (
-      id text primary key,
-      institution_id text,
-      institution_name text,
-      is_cuny boolean);
-    insert into updates values ('nys_institutions') on conflict do nothing;
-    """)
-    print(f'Adding {len(cuny_institutions)} CUNY institutions')
-    for key, value in cuny_institutions.items():
-      cursor.execute("""insert into nys_institutions values(%s, %s, %s, %s)
-                      """, (key, value[0], value[1], True))
-    print(f'Adding {len(option_elements)} NYS institutions')
-    for option_element in option_elements:
-      institution_id, institution_name = option_element.split(maxsplit=1)
-      assert institution_id.isdecimal()
-      institution_id = f'{int(institution_id):06}'
-      cursor.execute("""insert into nys_institutions values(%s, %s, %s, %s)
-                      """, (institution_id, institution_id, institution_name.strip(), False))
-    today = date.today().strftime('%Y-%m-%d')
-    cursor.execute("""
-    update updates set update_date = CURRENT_DATE
-     where table_name='nys_institutions'
-    """)
+    raise InstitutionsPageError(f'received {len(option_elements)} institutions from {url} '
+                                f'(expected 400+).')
+  return option_elements
+
+
+# institution_rows()
+# -------------------------------------------------------------------------------------------------
+def institution_rows(option_elements: List[str]) -> List[Tuple[str, str, str, bool]]:
+  """ The (id, institution_id, institution_name, is_cuny) rows for the table: the CUNY rows first,
+      then the others, each ordered by id.
+  """
+  rows = [(key, value[0], value[1], True) for key, value in cuny_institutions.items()]
+  for option_element in option_elements:
+    institution_id, institution_name = option_element.split(maxsplit=1)
+    assert institution_id.isdecimal()
+    institution_id = f'{int(institution_id):06}'
+    rows.append((institution_id, institution_id, institution_name.strip(), False))
+  return sorted(rows, key=lambda row: (not row[3], row[0]))
+
+
+def rows_hash(rows: Iterable[Tuple]) -> str:
+  """ Hash of a set of rows, whatever their order. """
+  content = '\n'.join('\x1f'.join(str(value) for value in row) for row in sorted(rows))
+  return hashlib.sha256(content.encode()).hexdigest()
+
+
+# current_hash()
+# -------------------------------------------------------------------------------------------------
+def current_hash(cursor) -> Optional[str]:
+  """ Hash of the nys_institutions table’s rows, or None if there is no table.
+  """
+  cursor.execute("select to_regclass('nys_institutions') is not null as exists")
+  if not cursor.fetchone().exists:
+    return None
+  cursor.execute("""
+  select id, institution_id, institution_name, is_cuny
+    from nys_institutions
+  """)
+  # rows_hash() sorts the rows, so the order does not depend on the database’s collation.
+  return rows_hash(tuple(row) for row in cursor.fetchall())
+
+
+# update_nys_institutions()
+# -------------------------------------------------------------------------------------------------
+def update_nys_institutions(conn) -> bool:
+  """ Rebuild the nys_institutions table from the NYSED website, unless its contents would not
+      change. Returns True if the table was rebuilt.
+
+      The rows are loaded with COPY into a staging table, which replaces nys_institutions once its
+      row counts have been checked, all in one transaction: other sessions see either the old table
+      or the new one, never a missing or partly loaded one.
+  """
+  option_elements = fetch_institutions()
+  rows = institution_rows(option_elements)
+  num_cuny = len(cuny_institutions)
+
+  with metrics.phase('db_write'), conn.transaction():
+    with conn.cursor(row_factory=namedtuple_row) as cursor:
+      cursor.execute("insert into updates values ('nys_institutions') on conflict do nothing")
+      rebuild = current_hash(cursor) != rows_hash(rows)
+      if rebuild:
+        print(f'Loading {num_cuny} CUNY and {len(rows) - num_cuny} NYS institutions')
+        cursor.execute("""
+        drop table if exists nys_institutions_staging;
+        create table nys_institutions_staging (
+          id text,
+          institution_id text,
+          institution_name text,
+          is_cuny boolean);
+        """)
+        with cursor.copy('copy nys_institutions_staging (id, institution_id, institution_name, '
+                         'is_cuny) from stdin') as copy:
+          for row in rows:
+            copy.write_row(row)
+        cursor.execute("""
+        select count(*) as num_rows, count(*) filter (where is_cuny) as num_cuny
+          from nys_institutions_staging
+        """)
+        counts = cursor.fetchone()
+        if counts.num_rows != len(rows) or counts.num_cuny != num_cuny:
+          raise InstitutionsPageError(f'staged {counts.num_rows} rows ({counts.num_cuny} CUNY); '
+                                      f'expected {len(rows)} ({num_cuny} CUNY)')
+        cursor.execute("""
+        drop table if exists nys_institutions;
+        alter table nys_institutions_staging rename to nys_institutions;
+        alter table nys_institutions add primary key (id);
+        """)
+        metrics.count('rows_written', len(rows))
+      else:
+        print(f'nys_institutions is up to date ({len(rows)} institutions)')
+      cursor.execute("""
+      update updates set update_date = CURRENT_DATE
+       where table_name='nys_institutions'
+      """)
+  return rebuild
+
+
+if __name__ == '__main__':
+  save_on_exit(script_file)
+  try:
+    with psycopg.connect('dbname=cuny_curriculum', cursor_factory=CountingCursor) as conn:
+      update_nys_institutions(conn)
+  except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+    exit(f'{script_file}: ERROR: {INSTITUTIONS_URL} failed: {err}')
+  except InstitutionsPageError as err:
+    exit(f'{script_file}: ERROR: {err}')
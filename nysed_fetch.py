@@ -0,0 +1,393 @@
+""" Fetch pages from the NYSED website.
+
+    Phase II of registered_programs.py needs one IRPSL3 detail page per program code. Those
+    requests are independent of each other, so they can be made concurrently by a bounded pool of
+    worker threads. The pages are always handed back in the order the program codes were given, so
+    the parser sees exactly the same sequence of pages as it would for a sequential run.
+
+    Every request goes through the same safeguards, so that no fetch can hang a run and a run
+    finishes within a predictable time:
+      * A FetchPolicy gives each request a connect timeout and a limit on its total time, and can
+        give the whole run a deadline, after which fetches fail with DeadlineExceeded.
+      * Connection errors, timeouts, and 429 or 5xx responses are retried, after jittered
+        exponential backoff, up to the policy’s number of retries.
+      * A RateLimiter is a token bucket for each host that slows down when NYSED responds slowly or
+        with errors, and speeds back up (to at most the configured rate) when it recovers.
+      * A CircuitBreaker for each host stops sending requests after several consecutive failures;
+        fetches fail fast with CircuitOpen until a cooldown has passed and a trial request works.
+    DeadlineExceeded is a requests Timeout and CircuitOpen is a requests ConnectionError, so callers
+    that handle those handle these too.
+
+    If a PageCache is supplied, responses are looked up there first and saved there after being
+    fetched. A cache in replay mode never goes to the network; see page_cache.py.
+
+    The pages can be fetched from somewhere else, such as the stub server in
+    benchmarks/stub_server.py, by setting NYSED_URL (for the www2.nysed.gov registration pages)
+    and NYSED_WWW_URL (for the www.nysed.gov HEGIS and format definition pages) in the environment.
+"""
+import os
+import random
+import threading
+import time
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+from page_cache import Page, PageCache
+from requests.compat import chardet
+from typing import Dict, Iterable, Iterator, Mapping, Optional, Tuple
+from urllib.parse import urlsplit
+
+NYSED_URL = os.environ.get('NYSED_URL', 'https://www2.nysed.gov').rstrip('/')
+INSTITUTIONS_URL = f'{NYSED_URL}/coms/rp090/IRPSL1/'
+PROGRAMS_URL = f'{NYSED_URL}/coms/rp090/IRPS2A'
+DETAIL_URL = f'{NYSED_URL}/COMS/RP090/IRPSL3?PROGCD={{}}'
+NYSED_WWW_URL = os.environ.get('NYSED_WWW_URL', 'http://www.nysed.gov').rstrip('/')
+HEGIS_URL = (f'{NYSED_WWW_URL}/college-university-evaluation/'
+             f'new-york-state-taxonomy-academic-programs-hegis-codes')
+FORMATS_URL = f'{NYSED_WWW_URL}/college-university-evaluation/format-definitions'
+
+# Responses worth retrying.
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+  """ The run’s deadline passed before a page could be fetched. """
+  pass
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+  """ Requests to a host are suspended after repeated failures. """
+  pass
+
+
+def _host(url: str) -> str:
+  return urlsplit(url).netloc
+
+
+# class FetchPolicy
+# -------------------------------------------------------------------------------------------------
+class FetchPolicy(object):
+  """ Timeouts, retries, and the run deadline for fetches.
+
+      connect_timeout and request_timeout (the most time a single attempt may take, including
+      reading the response) are in seconds. Retry n waits a random time up to
+      min(max_backoff, backoff × 2ⁿ) seconds. deadline is the number of seconds from now that the
+      run may keep fetching; None means no deadline.
+  """
+
+  def __init__(self, connect_timeout: float = 10.0, request_timeout: float = 120.0,
+               retries: int = 4, backoff: float = 1.0, max_backoff: float = 30.0,
+               deadline: Optional[float] = None):
+    self.connect_timeout = connect_timeout
+    self.request_timeout = request_timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.set_deadline(deadline)
+
+  def set_deadline(self, seconds: Optional[float]):
+    self.deadline = None if seconds is None else time.monotonic() + seconds
+
+  def remaining(self) -> Optional[float]:
+    """ Seconds left before the deadline, or None if there is no deadline. """
+    return None if self.deadline is None else self.deadline - time.monotonic()
+
+  def check_deadline(self, url: str):
+    remaining = self.remaining()
+    if remaining is not None and remaining <= 0:
+      raise DeadlineExceeded(f'Run deadline passed before fetching {url}')
+
+  def attempt_timeout(self) -> float:
+    """ Time allowed for one attempt: the request timeout, cut short by the deadline. """
+    remaining = self.remaining()
+    return self.request_timeout if remaining is None else min(self.request_timeout, remaining)
+
+  def retry_delay(self, retry: int) -> float:
+    """ Full-jitter exponential backoff before the given retry (0 for the first). """
+    return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+
+
+# class RateLimiter
+# -------------------------------------------------------------------------------------------------
+class RateLimiter(object):
+  """ Token bucket for each host, allowing at most rate request starts per second, with bursts of
+      up to burst requests. A rate of None (or zero) means no limit until trouble is seen.
+
+      The rate adapts to how each host is doing: a failed request halves it, and a response slower
+      than slow seconds cuts it by a fifth. (If there was no limit, it starts from fallback_rate.)
+      Each fast response raises it by a tenth of the starting rate again, up to the configured
+      rate; without a configured rate the limit is lifted once it is back above unlimited_rate.
+  """
+
+  def __init__(self, rate: Optional[float] = None, burst: float = 1.0, min_rate: float = 0.2,
+               slow: float = 5.0, fallback_rate: float = 2.0, unlimited_rate: float = 20.0):
+    self.max_rate = rate or None
+    self.burst = burst
+    self.min_rate = min_rate
+    self.slow = slow
+    self.fallback_rate = fallback_rate
+    self.unlimited_rate = unlimited_rate
+    self._lock = threading.Lock()
+    # host -> [rate, tokens, time of last refill]
+    self._buckets: Dict[str, list] = {}
+
+  def _bucket(self, host: str) -> list:
+    bucket = self._buckets.get(host)
+    if bucket is None:
+      bucket = self._buckets[host] = [self.max_rate, self.burst, time.monotonic()]
+    return bucket
+
+  def rate(self, url: str) -> Optional[float]:
+    """ Current rate for url’s host. """
+    with self._lock:
+      return self._bucket(_host(url))[0]
+
+  def wait(self, url: str):
+    """ Block until a request to url’s host may start.
+    """
+    with self._lock:
+      bucket = self._bucket(_host(url))
+      rate, tokens, last = bucket
+      if rate is None:
+        return
+      now = time.monotonic()
+      tokens = min(self.burst, tokens + (now - last) * rate) - 1
+      bucket[1:] = [tokens, now]
+    # A negative balance reserves a future slot; wait for it.
+    if tokens < 0:
+      time.sleep(-tokens / rate)
+
+  def _adjust(self, url: str, factor: float):
+    with self._lock:
+      bucket = self._bucket(_host(url))
+      rate = bucket[0] if bucket[0] is not None else self.fallback_rate / factor
+      bucket[0] = max(self.min_rate, rate * factor)
+
+  def success(self, url: str, latency: float):
+    if latency > self.slow:
+      self._adjust(url, 0.8)
+      return
+    with self._lock:
+      bucket = self._bucket(_host(url))
+      if bucket[0] is None:
+        return
+      bucket[0] += (self.max_rate or self.fallback_rate) / 10
+      if self.max_rate is not None:
+        bucket[0] = min(bucket[0], self.max_rate)
+      elif bucket[0] > self.unlimited_rate:
+        bucket[0] = None
+
+  def failure(self, url: str):
+    self._adjust(url, 0.5)
+
+
+# class CircuitBreaker
+# -------------------------------------------------------------------------------------------------
+class CircuitBreaker(object):
+  """ Stop sending requests to a host after threshold consecutive failures. Once cooldown seconds
+      have passed, one trial request is let through: success closes the circuit again, failure
+      keeps it open for another cooldown.
+  """
+
+  def __init__(self, threshold: int = 5, cooldown: float = 60.0):
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self._lock = threading.Lock()
+    self._failures = 0
+    self._opened_at: Optional[float] = None
+    self._trial = False
+
+  def before_request(self, url: str):
+    with self._lock:
+      if self._opened_at is None:
+        return
+      if time.monotonic() - self._opened_at < self.cooldown or self._trial:
+        metrics.count('circuit_open')
+        raise CircuitOpen(f'Requests to {_host(url)} suspended after {self._failures} '
+                          f'consecutive failures')
+      self._trial = True
+
+  def success(self):
+    with self._lock:
+      self._failures = 0
+      self._opened_at = None
+      self._trial = False
+
+  def failure(self):
+    with self._lock:
+      self._failures += 1
+      if self._trial or self._failures >= self.threshold:
+        self._opened_at = time.monotonic()
+      self._trial = False
+
+
+# The defaults used by fetch_page() when no policy or limiter is given. See configure().
+default_policy = FetchPolicy()
+default_limiter = RateLimiter()
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def configure(rate: Optional[float] = None, **kwargs):
+  """ Replace the default policy (kwargs are FetchPolicy arguments) and rate limiter.
+  """
+  global default_policy, default_limiter
+  default_policy = FetchPolicy(**kwargs)
+  default_limiter = RateLimiter(rate)
+
+
+def circuit_breaker(url: str) -> CircuitBreaker:
+  """ The circuit breaker for url’s host. """
+  host = _host(url)
+  with _breakers_lock:
+    if host not in _breakers:
+      _breakers[host] = CircuitBreaker()
+    return _breakers[host]
+
+
+# Each worker thread gets its own Session so connections are reused without sharing a Session
+# between threads.
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+  if not hasattr(_local, 'session'):
+    _local.session = requests.Session()
+  return _local.session
+
+
+def _attempt(url: str, data: Optional[dict], fetch_policy: FetchPolicy) -> Page:
+  """ One request, read in chunks so that the whole attempt, not just each read, is limited to the
+      policy’s attempt timeout.
+  """
+  timeout = fetch_policy.attempt_timeout()
+  give_up = time.monotonic() + timeout
+  session = _session()
+  kwargs = {'timeout': (min(fetch_policy.connect_timeout, timeout), timeout), 'stream': True}
+  with (session.get(url, **kwargs) if data is None
+        else session.post(url, data=data, **kwargs)) as r:
+    chunks = []
+    for chunk in r.iter_content(64 * 1024):
+      chunks.append(chunk)
+      if time.monotonic() > give_up:
+        raise requests.exceptions.ReadTimeout(f'{url} took more than {timeout:.0f} seconds')
+    content = b''.join(chunks)
+    encoding = r.encoding or (chardet.detect(content)['encoding'] if content else None) or 'utf-8'
+    return Page(content, encoding, r.status_code)
+
+
+# fetch_page()
+# -------------------------------------------------------------------------------------------------
+def fetch_page(url: str, data: Optional[dict] = None,
+               cache: Optional[PageCache] = None,
+               limiter: Optional[RateLimiter] = None,
+               policy: Optional[FetchPolicy] = None) -> Page:
+  """ GET url, or POST data to it if there is any, going through the cache if there is one.
+      Failed attempts are retried as the policy allows; if the last attempt got a response, even
+      an error response, that is returned.
+  """
+  if cache is not None:
+    page = cache.get(url, data)
+    if page is not None:
+      return page
+  fetch_policy = policy or default_policy
+  rate_limiter = limiter or default_limiter
+  breaker = circuit_breaker(url)
+
+  retry = 0
+  while True:
+    fetch_policy.check_deadline(url)
+    breaker.before_request(url)
+    rate_limiter.wait(url)
+    start = time.perf_counter()
+    try:
+      page, error = _attempt(url, data, fetch_policy), None
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+      page, error = None, err
+    latency = time.perf_counter() - start
+    failed = error is not None or page.status in RETRY_STATUSES
+    metrics.record_request(url, latency, len(page.content) if page else 0, ok=not failed)
+
+    if not failed:
+      breaker.success()
+      rate_limiter.success(url, latency)
+      break
+    breaker.failure()
+    rate_limiter.failure(url)
+    if retry >= fetch_policy.retries:
+      if error is not None:
+        raise error
+      break
+    delay = fetch_policy.retry_delay(retry)
+    remaining = fetch_policy.remaining()
+    if remaining is not None and delay >= remaining:
+      if error is not None:
+        raise DeadlineExceeded(f'Run deadline reached while retrying {url}: {error}')
+      break
+    metrics.count('http_retries')
+    time.sleep(delay)
+    retry += 1
+
+  if cache is not None and page.status == requests.codes.ok:
+    cache.put(url, data, page)
+  return page
+
+
+# fetch_detail()
+# -------------------------------------------------------------------------------------------------
+def fetch_detail(program_code: str,
+                 cache: Optional[PageCache] = None,
+                 limiter: Optional[RateLimiter] = None) -> str:
+  """ Return the text of the IRPSL3 detail page for one program code.
+  """
+  return fetch_page(DETAIL_URL.format(program_code), cache=cache, limiter=limiter).text
+
+
+# fetch_details()
+# -------------------------------------------------------------------------------------------------
+def fetch_details(program_codes: Iterable[str],
+                  workers: int = 1,
+                  rate: Optional[float] = None,
+                  cache: Optional[PageCache] = None,
+                  pages: Optional[Mapping[str, str]] = None) -> Iterator[Tuple[str, str]]:
+  """ Yield (program_code, page_text) for each program code, in the order given.
+
+      With one worker the pages are fetched one at a time, just as they always were. With more,
+      up to that many requests are in flight at once; pages that arrive early are held until all
+      the ones before them have been yielded. Request exceptions propagate to the caller when the
+      page that raised them is reached.
+
+      Requests are limited to rate per second if it is given, and otherwise by the default rate
+      limiter. Program codes whose text is already in pages (when it is given) are not fetched at
+      all.
+  """
+  program_codes = list(program_codes)
+  if pages is None:
+    pages = {}
+  # Decide which pages to fetch up front: the caller may add to pages while iterating.
+  known = {program_code: pages[program_code]
+           for program_code in program_codes if program_code in pages}
+  to_fetch = [program_code for program_code in program_codes if program_code not in known]
+  rate_limiter = RateLimiter(rate) if rate else None
+  if workers < 2:
+    fetched = (fetch_detail(program_code, cache, rate_limiter) for program_code in to_fetch)
+    for program_code in program_codes:
+      yield program_code, known[program_code] if program_code in known else next(fetched)
+    return
+
+  # Count the workers’ requests in the caller’s phase.
+  phases = metrics.current_phases()
+
+  def fetch(program_code: str) -> str:
+    with metrics.within(phases):
+      return fetch_detail(program_code, cache, rate_limiter)
+
+  executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='nysed')
+  try:
+    fetched = executor.map(fetch, to_fetch)
+    for program_code in program_codes:
+      yield program_code, known[program_code] if program_code in known else next(fetched)
+  finally:
+    # If the caller stops early (error or exit), don’t wait for the rest of the pages.
+    executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,133 @@
+""" On-disk cache of raw responses from the NYSED website.
+
+    Each response is stored under the SHA-256 hash of its request (method, URL, and form data), as
+    a body file holding the raw bytes and a small JSON file recording the request and the encoding
+    needed to decode the body. Entries older than the TTL are treated as misses, and once the
+    cache grows past its size limit the oldest entries are evicted.
+
+    In replay mode the cache is the only source of pages: the TTL is ignored (so yesterday’s pages
+    can be re-parsed) and a miss is an error rather than a reason to go to the network.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional, Tuple
+
+DEFAULT_CACHE_DIR = Path(__file__).parent / 'page_cache'
+
+
+class CacheMiss(LookupError):
+  """ A page needed in replay mode is not in the cache.
+  """
+  pass
+
+
+class Page(NamedTuple):
+  """ Raw response bytes plus the encoding to use when treating them as text, and the HTTP status.
+      (Only successful responses are cached.)
+  """
+  content: bytes
+  encoding: str
+  status: int = 200
+
+  @property
+  def text(self) -> str:
+    return str(self.content, self.encoding, errors='replace')
+
+
+# class PageCache
+# -------------------------------------------------------------------------------------------------
+class PageCache(object):
+  """ Content-addressed store of NYSED responses, keyed by request.
+  """
+
+  def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl: Optional[float] = 12 * 3600,
+               max_bytes: Optional[int] = 500 * 1024 * 1024, replay: bool = False):
+    self.cache_dir = Path(cache_dir)
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self.replay = replay
+    self.hits = self.misses = 0
+    self._lock = threading.Lock()
+    # Size and age of each body file, for eviction.
+    self._entries: Dict[Path, Tuple[float, int]] = {}
+    self._total_bytes = 0
+    self.cache_dir.mkdir(parents=True, exist_ok=True)
+    for body_file in self.cache_dir.glob('*/*.body'):
+      st = body_file.stat()
+      self._entries[body_file] = (st.st_mtime, st.st_size)
+      self._total_bytes += st.st_size
+
+  @staticmethod
+  def key(url: str, data: Optional[dict] = None) -> str:
+    """ Hash of the request: GET if there is no form data, otherwise POST.
+    """
+    request = {'method': 'GET' if data is None else 'POST',
+               'url': url,
+               'data': None if data is None else sorted((str(k), str(v)) for k, v in data.items())}
+    return hashlib.sha256(json.dumps(request).encode()).hexdigest()
+
+  def _paths(self, key: str) -> Tuple[Path, Path]:
+    subdir = self.cache_dir / key[:2]
+    return subdir / f'{key}.body', subdir / f'{key}.json'
+
+  def get(self, url: str, data: Optional[dict] = None) -> Optional[Page]:
+    """ Return the cached page for this request, or None if it is missing or stale.
+    """
+    body_file, meta_file = self._paths(self.key(url, data))
+    try:
+      if not self.replay and self.ttl is not None:
+        if time.time() - body_file.stat().st_mtime > self.ttl:
+          raise FileNotFoundError(body_file)
+      encoding = json.loads(meta_file.read_text())['encoding']
+      page = Page(body_file.read_bytes(), encoding)
+    except (FileNotFoundError, KeyError, ValueError):
+      with self._lock:
+        self.misses += 1
+      if self.replay:
+        raise CacheMiss(f'{url} {data if data else ""} is not in {self.cache_dir}')
+      return None
+    with self._lock:
+      self.hits += 1
+    return page
+
+  def put(self, url: str, data: Optional[dict], page: Page):
+    """ Store a page, then evict the oldest entries if the cache is over its size limit.
+    """
+    body_file, meta_file = self._paths(self.key(url, data))
+    body_file.parent.mkdir(exist_ok=True)
+    # Write to temporary names and rename, so concurrent readers never see a partial entry.
+    suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+    tmp_meta = meta_file.with_name(meta_file.name + suffix)
+    tmp_meta.write_text(json.dumps({'url': url, 'data': data, 'encoding': page.encoding}))
+    os.replace(tmp_meta, meta_file)
+    tmp_body = body_file.with_name(body_file.name + suffix)
+    tmp_body.write_bytes(page.content)
+    os.replace(tmp_body, body_file)
+
+    with self._lock:
+      _, old_size = self._entries.get(body_file, (0, 0))
+      self._entries[body_file] = (time.time(), len(page.content))
+      self._total_bytes += len(page.content) - old_size
+      if self.max_bytes is not None and self._total_bytes > self.max_bytes:
+        self._evict()
+
+  def _evict(self):
+    """ Remove oldest entries until the cache is at most 90% of its size limit. Caller holds the
+        lock.
+    """
+    target = self.max_bytes * 0.9
+    for body_file, (mtime, size) in sorted(self._entries.items(), key=lambda item: item[1][0]):
+      if self._total_bytes <= target:
+        break
+      for path in (body_file, body_file.with_suffix('.json')):
+        try:
+          path.unlink()
+        except FileNotFoundError:
+          pass
+      del self._entries[body_file]
+      self._total_bytes -= size
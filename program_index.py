@@ -0,0 +1,274 @@
+#! /usr/local/bin/python3
+""" Read-only, in-memory index of the registered_programs table, for fast lookups by the transfer
+    app.
+
+    A snapshot of the table is held in columns: each text column is a list of its distinct values
+    plus an array of small integer codes, one per row. Hash indexes map each program code, HEGIS
+    code, award, institution, target institution, and CIP code (from cuny_programs) to the array of
+    row numbers that have it. A query intersects the row numbers for the fields it gives, starting
+    with the shortest list, and builds Program tuples only for the rows that match:
+
+      index = ProgramIndex()
+      index.query(hegis='1701')                               # HEGIS 1701.00, 1701.10, ...
+      index.query(program_code='36256')                       # All variants of one program
+      index.query(cip='52.02', award=['BA', 'BS'], target_institution='qns')
+
+    A field’s value can be a single value or a list of alternatives. HEGIS and CIP codes match by
+    prefix; institutions match without regard to case.
+
+    The index checks the updates table at most once every check_interval seconds, and loads a new
+    snapshot when it shows a newer registered_programs date. Queries in progress keep using the
+    snapshot they started with.
+"""
+import argparse
+import psycopg
+import threading
+import time
+
+from array import array
+from datetime import date
+from psycopg.rows import namedtuple_row
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+CONNINFO = 'dbname=cuny_curriculum'
+
+# registered_programs columns held in the index, in Program order.
+COLUMNS = ('target_institution',
+           'program_code',
+           'unit_code',
+           'institution',
+           'title',
+           'award',
+           'formats',
+           'hegis',
+           'certificate_license',
+           'accreditation',
+           'first_registration_date',
+           'last_registration_action',
+           'tap', 'apts', 'vvta')
+
+# Indexed fields, with whether their values match by prefix, and whether case matters.
+INDEXED = {'program_code': (False, True),
+           'hegis': (True, True),
+           'award': (False, True),
+           'institution': (False, False),
+           'target_institution': (False, False),
+           'cip': (True, True)}
+
+
+class Program(NamedTuple):
+  target_institution: str
+  program_code: str
+  unit_code: str
+  institution: str
+  title: str
+  award: str
+  formats: str
+  hegis: str
+  certificate_license: str
+  accreditation: str
+  first_registration_date: str
+  last_registration_action: str
+  tap: str
+  apts: str
+  vvta: str
+  is_variant: bool
+  cip_codes: Tuple[str, ...]
+
+
+# class _Column
+# -------------------------------------------------------------------------------------------------
+class _Column(object):
+  """ Dictionary-encoded column: the distinct values, and each row’s index into them.
+  """
+  __slots__ = ('values', 'codes', '_lookup')
+
+  def __init__(self):
+    self.values: List = []
+    self.codes = array('I')
+    self._lookup: Dict = {}
+
+  def append(self, value):
+    code = self._lookup.get(value)
+    if code is None:
+      code = self._lookup[value] = len(self.values)
+      self.values.append(value)
+    self.codes.append(code)
+
+  def __getitem__(self, row: int):
+    return self.values[self.codes[row]]
+
+
+# class Snapshot
+# -------------------------------------------------------------------------------------------------
+class Snapshot(object):
+  """ The registered_programs table, as of one update date, in columns with hash indexes.
+  """
+
+  def __init__(self, conn, update_date: Optional[date]):
+    self.update_date = update_date
+    self.columns = {column: _Column() for column in COLUMNS}
+    self.is_variant = array('b')
+    self.indexes: Dict[str, Dict[str, array]] = {field: {} for field in INDEXED}
+
+    with conn.cursor(row_factory=namedtuple_row) as cursor:
+      # CIP codes of the active CUNY programs (plans) for each NYS program code.
+      cursor.execute("""
+        select distinct nys_program_code, cip_code
+          from cuny_programs
+         where program_status = 'A' and cip_code is not null
+      """)
+      cip_codes: Dict[str, List[str]] = {}
+      for row in cursor:
+        cip_codes.setdefault(str(row.nys_program_code), []).append(str(row.cip_code))
+      self.cip_codes = {program_code: tuple(sorted(codes))
+                        for program_code, codes in cip_codes.items()}
+
+      cursor.execute(f"""
+        select {', '.join(COLUMNS)}, is_variant
+          from registered_programs
+         order by target_institution, title, program_code
+      """)
+      for row_number, row in enumerate(cursor):
+        for column in COLUMNS:
+          self.columns[column].append(getattr(row, column))
+        self.is_variant.append(bool(row.is_variant))
+        for field in INDEXED:
+          values = (self.cip_codes.get(row.program_code, ()) if field == 'cip'
+                    else (getattr(row, field), ))
+          for value in values:
+            if value is not None:
+              self._postings(field, value).append(row_number)
+    self.num_rows = len(self.is_variant)
+
+  def _postings(self, field: str, value: str) -> array:
+    key = value if INDEXED[field][1] else value.lower()
+    postings = self.indexes[field].get(key)
+    if postings is None:
+      postings = self.indexes[field][key] = array('I')
+    return postings
+
+  def row(self, row_number: int) -> Program:
+    values = [self.columns[column][row_number] for column in COLUMNS]
+    return Program(*values, bool(self.is_variant[row_number]),
+                   self.cip_codes.get(values[1], ()))
+
+  def matching(self, field: str, values: Iterable[str]) -> List[array]:
+    """ The posting lists of the field’s keys that match any of the values. """
+    by_prefix, case_matters = INDEXED[field]
+    index = self.indexes[field]
+    keys = [value if case_matters else value.lower() for value in values]
+    if by_prefix:
+      return [index[key] for key in index if any(key.startswith(prefix) for prefix in keys)]
+    return [index[key] for key in keys if key in index]
+
+  def row_numbers(self, criteria: Dict[str, Sequence[str]]) -> List[int]:
+    """ The numbers of the rows that match all the criteria, in row order.
+    """
+    if not criteria:
+      return list(range(self.num_rows))
+    # Each field’s alternatives are combined into one candidate set; the field with the fewest
+    # candidates goes first, so the intersection stays small.
+    candidates = []
+    for field, values in criteria.items():
+      postings = self.matching(field, values)
+      size = sum(len(posting) for posting in postings)
+      if size == 0:
+        return []
+      candidates.append((size, postings))
+    candidates.sort(key=lambda candidate: candidate[0])
+    rows = set().union(*candidates[0][1])
+    for _, postings in candidates[1:]:
+      rows.intersection_update(set().union(*postings))
+      if not rows:
+        return []
+    return sorted(rows)
+
+
+# class ProgramIndex
+# -------------------------------------------------------------------------------------------------
+class ProgramIndex(object):
+  """ Queries against the latest snapshot of registered_programs.
+  """
+
+  def __init__(self, conninfo: str = CONNINFO, check_interval: float = 60.0):
+    self.conninfo = conninfo
+    self.check_interval = check_interval
+    self._lock = threading.Lock()
+    self._snapshot: Optional[Snapshot] = None
+    self._checked = 0.0
+
+  @staticmethod
+  def _update_date(conn) -> Optional[date]:
+    with conn.cursor(row_factory=namedtuple_row) as cursor:
+      cursor.execute("""
+        select update_date from updates where table_name = 'registered_programs'
+      """)
+      row = cursor.fetchone()
+    return None if row is None else row.update_date
+
+  @property
+  def snapshot(self) -> Snapshot:
+    """ The current snapshot, reloaded first if the table has been updated since it was taken.
+    """
+    snapshot = self._snapshot
+    if snapshot is not None and time.monotonic() - self._checked < self.check_interval:
+      return snapshot
+    with self._lock:
+      # Another thread may have just checked.
+      if self._snapshot is not None and time.monotonic() - self._checked < self.check_interval:
+        return self._snapshot
+      with psycopg.connect(self.conninfo) as conn:
+        update_date = self._update_date(conn)
+        if (self._snapshot is None
+            or (update_date is not None and (self._snapshot.update_date is None
+                                             or update_date > self._snapshot.update_date))):
+          self._snapshot = Snapshot(conn, update_date)
+      self._checked = time.monotonic()
+      return self._snapshot
+
+  def reload(self):
+    """ Load a new snapshot now, whether or not the table has been updated. """
+    with self._lock, psycopg.connect(self.conninfo) as conn:
+      self._snapshot = Snapshot(conn, self._update_date(conn))
+      self._checked = time.monotonic()
+
+  def query(self, **criteria: Union[str, Sequence[str], None]) -> List[Program]:
+    """ The programs that match all the criteria given; see the module docstring. Criteria that
+        are None are ignored.
+    """
+    snapshot = self.snapshot
+    return [snapshot.row(row_number)
+            for row_number in snapshot.row_numbers(self._criteria(criteria))]
+
+  def count(self, **criteria: Union[str, Sequence[str], None]) -> int:
+    """ The number of programs that match all the criteria given. """
+    return len(self.snapshot.row_numbers(self._criteria(criteria)))
+
+  @staticmethod
+  def _criteria(criteria: Dict) -> Dict[str, Sequence[str]]:
+    unknown = set(criteria) - set(INDEXED)
+    if unknown:
+      raise TypeError(f'Cannot query by {", ".join(sorted(unknown))}')
+    return {field: [values] if isinstance(values, str) else list(values)
+            for field, values in criteria.items() if values is not None}
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Query registered programs')
+  for field in INDEXED:
+    parser.add_argument(f'--{field}', nargs='+', metavar='VALUE')
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  index = ProgramIndex()
+  snapshot = index.snapshot
+  print(f'Loaded {snapshot.num_rows:,} rows as of {snapshot.update_date} in '
+        f'{time.perf_counter() - start:0.2f} sec')
+  start = time.perf_counter()
+  programs = index.query(**{field: getattr(args, field) for field in INDEXED})
+  elapsed = time.perf_counter() - start
+  for program in programs:
+    print(f'{program.target_institution:<4} {program.program_code:<6} {program.award:<8} '
+          f'{program.hegis:<8} {", ".join(program.cip_codes):<20} {program.title}')
+  print(f'{len(programs):,} programs in {elapsed * 1000:0.1f} ms')
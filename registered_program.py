@@ -1,10 +1,12 @@
-""" The RegisteredProgram class, which is a list of NYS-registered academic programs.
+""" The RegisteredProgram class, which is a list of NYS-registered academic programs, and the
+    ProgramRegistry that holds the programs found for one institution.
 """
 import re
-from typing import Dict, Any
-from recordclass import recordclass
+from functools import lru_cache
+from operator import attrgetter
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 
-_items = ['institution',
+_items = ('institution',
           'title',
           'award',
           'hegis',
@@ -12,26 +14,67 @@ _items = ['institution',
           'last_registration_action',
           'tap', 'apts', 'vvta',
           'certificate_license',
-          'accreditation']
-_variant_info = recordclass('Variant_Info', _items, mapping=True)
+          'accreditation')
+
+
+class Variant_Info(object):
+  """ Per-variant values. Fields can be accessed as attributes or, by name, as items.
+  """
+  __slots__ = _items
+
+  def __init__(self, award, hegis, institution):
+    for field in _items:
+      setattr(self, field, None)
+    self.award = award
+    self.hegis = hegis
+    self.institution = institution
+
+  def __getitem__(self, field):
+    return getattr(self, field)
+
+  def __setitem__(self, field, value):
+    setattr(self, field, value)
+
+  def __repr__(self):
+    return (f'Variant_Info('
+            + ', '.join(f'{field}={getattr(self, field)!r}' for field in _items) + ')')
+
+
+@lru_cache(maxsize=None)
+def _column_getter(headings: Tuple[str, ...]) -> Callable[[Variant_Info], List]:
+  """ Function that returns the values of a variant for a sequence of column headings, built once
+      per sequence of headings.
+  """
+  fields = [h.lower().replace(' or ', '_').replace(' ', '_') for h in headings]
+  getter = attrgetter(*fields)
+  if len(fields) == 1:
+    return lambda variant: [getter(variant)]
+  return lambda variant: list(getter(variant))
 
 
 class RegisteredProgram(object):
   """ For each program registered with NYS Department of Education, collect information about the
       program scraped from the DoE website.
 
-      Some programs appear more than once, so a class list of programs instances prevents duplicate
-      entries.
-
       A single program can have multiple variants, which differ in title, institution, award, and/or
       hegis. Emprically, no two variants share the same {award, hegis, and institution} combination,
       so that tuple is used as the key for a dictionary of per-variant values. All variants of a
       program share a single program code and unit code.
 
-      Variant details are maintained as a recordclass so the values can be updated as new records
-      are retrieved from nys. [A recordclass is like a namedtuple, but the values are mutable.
-      Problem is, recordclass is still in beta ... but seems to be under active development.]
+      Variant details are kept in Variant_Info objects, which use __slots__ so that the many
+      variants of a large institution take little memory, and whose values can be updated as new
+      records are retrieved from nys.
+
+      The variant keys are also indexed by award and by institution, so the variants a for-award
+      group or a NOT-GRANTING line applies to are found without scanning all the program’s variants,
+      which matters for consortial programs with many M/I partners. Variants must be added with
+      new_variant() and removed with remove_variants() to keep the indexes current.
+
+      Programs are normally created through a ProgramRegistry, which ensures there is just one
+      instance per program code.
   """
+  __slots__ = ('program_code', 'unit_code', 'formats', 'variants',
+               '_by_award', '_by_institution', '_awards')
 
   # Default heading strings for the html and values functions. Overrideable in those methods’ calls
   # (mostly for debugging purposes).
@@ -45,36 +88,25 @@ class RegisteredProgram(object):
                'Last Registration Action',
                'TAP', 'APTS', 'VVTA']
 
-  # The (public) programs dict is a class variable, indexed by program_code.
-  programs: Dict[str, Any] = {}
-
-  def __new__(self, program_code, unit_code=None, formats=None):
-    """ Return unique object for this program_code; create it first if necessary.
-    """
-    assert program_code.isdecimal(), f'Invalid program code: “{program_code}”'
-    if program_code not in RegisteredProgram.programs.keys():
-      RegisteredProgram.programs[program_code] = super().__new__(self)
-      RegisteredProgram.programs[program_code].program_code = program_code
-      RegisteredProgram.programs[program_code].unit_code = unit_code
-      RegisteredProgram.programs[program_code].formats = formats
-      RegisteredProgram.programs[program_code].variants = {}
-    return RegisteredProgram.programs[program_code]
-
   def __init__(self, program_code, unit_code='Unknown', formats='Unknown'):
-    assert self.program_code == program_code, f'“{self.program_code}” != “{program_code}”'
-    if self.unit_code is None:
-      self.unit_code = unit_code
-    if self.formats is None:
-      self.formats = formats
+    assert program_code.isdecimal(), f'Invalid program code: “{program_code}”'
+    self.program_code = program_code
+    self.unit_code = unit_code
+    self.formats = formats
+    self.variants: Dict[Tuple[str, str, str], Variant_Info] = {}
+    # Variant keys by award and by institution; the inner dicts are insertion-ordered sets.
+    self._by_award: Dict[str, Dict[Tuple[str, str, str], None]] = {}
+    self._by_institution: Dict[str, Dict[Tuple[str, str, str], None]] = {}
+    self._awards = None
 
   def new_variant(self, award, hegis, institution, **kwargs):
     assert re.match(r'\d{4}\.\d{2}', hegis), f'Invalid hegis code: “{hegis}”'
     variant_tuple = (award, hegis, institution)
     if variant_tuple not in self.variants.keys():
-      self.variants[variant_tuple] = _variant_info._make([None] * len(_items))
-      self.variants[variant_tuple].award = award
-      self.variants[variant_tuple].hegis = hegis
-      self.variants[variant_tuple].institution = institution.upper()
+      self.variants[variant_tuple] = Variant_Info(award, hegis, institution.upper())
+      self._by_award.setdefault(award, {})[variant_tuple] = None
+      self._by_institution.setdefault(institution, {})[variant_tuple] = None
+      self._awards = None
     for key, value in kwargs.items():
       self.variants[variant_tuple][key] = value
     return variant_tuple
@@ -85,31 +117,33 @@ class RegisteredProgram(object):
         Used for testing if a for-award group applies to this program.
         (Also used in __str__(), below.)
     """
-    return sorted([award for award, hegis, institution in self.variants.keys()])
+    if self._awards is None:
+      self._awards = sorted([award for award, hegis, institution in self.variants.keys()])
+    return self._awards
 
-  @classmethod
-  def html_table(this):
-    """ This html table is primarily for testing during development.
-        The transfer app generates html tables from the database info.
+  def award_variants(self, award):
+    """ Return the keys of the variants for an award.
     """
-    table = '<style>.variant {background-color:#fcc;}</style><table>'
-    table += '  <tr><th>Program Code</th><th>Registered By</th>'
-    table += """<th><a href="http://www.nysed.gov/college-university-evaluation/format-definitions">
-                Formats</a></th>"""
-    table += ''.join([f'<th>{head}</th>' for head in this._headings]) + '</tr>\n'
-    for p in this.programs:
-      program = this.programs[p]
-      which_class = ''
-      variants = program.variants.keys()
-      if len(variants) > 1:
-        which_class = 'variant'
-      for variant_tuple in variants:
-        this_class = (which_class + f' {variant_tuple}').strip()
-        table += f"""  <tr class="{this_class}">
-        <th>{program.program_code}</th><td>{program.unit_code}</td><td>{program.formats}</td>"""
-        table += ''.join([f'<td>{cell}</td>' for cell in program.values(variant_tuple)]) + '</tr>\n'
-    table += '</table>'
-    return table
+    return list(self._by_award.get(award, ()))
+
+  def remove_variants(self, award, institution):
+    """ Remove the variants for an award-institution pair; return the keys that were removed.
+    """
+    by_award = self._by_award.get(award)
+    by_institution = self._by_institution.get(institution)
+    if not by_award or not by_institution:
+      return []
+    if len(by_award) > len(by_institution):
+      removed = [key for key in by_institution if key[0] == award]
+    else:
+      removed = [key for key in by_award if key[2] == institution]
+    for variant_tuple in removed:
+      del self.variants[variant_tuple]
+      del by_award[variant_tuple]
+      del by_institution[variant_tuple]
+    if removed:
+      self._awards = None
+    return removed
 
   def values(self, variant_tuple, headings=None):
     """ Given a list of column headings, yield the corresponding values for each award/hegis combo.
@@ -117,9 +151,116 @@ class RegisteredProgram(object):
     """
     if headings is None:
       headings = self._headings
-    fields = [h.lower().replace(' or ', '_').replace(' ', '_') for h in headings]
-    return [self.variants[variant_tuple][field] for field in fields]
+    return _column_getter(tuple(headings))(self.variants[variant_tuple])
 
   def __str__(self):
     return (self.__repr__().replace('program.RegisteredProgram object', 'NYS Registered RegisteredProgram')
             + f' {self.program_code} {self.unit_code} {", ".join(self.awards)}')
+
+
+class ProgramRegistry(object):
+  """ The programs found for one institution (or one run), indexed by program code.
+
+      A registry replaces what used to be a class-wide dict of all programs ever created, so the
+      programs for one institution can be dropped once they have been written out, and several
+      institutions can be processed in one process without memory growing.
+  """
+
+  def __init__(self):
+    self.programs: Dict[str, RegisteredProgram] = {}
+
+  def program(self, program_code, unit_code='Unknown', formats='Unknown') -> RegisteredProgram:
+    """ Return the unique program for this program_code; create it first if necessary.
+    """
+    program = self.programs.get(program_code)
+    if program is None:
+      program = self.programs[program_code] = RegisteredProgram(program_code, unit_code, formats)
+    return program
+
+  def __len__(self):
+    return len(self.programs)
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self.programs)
+
+  def __contains__(self, program_code):
+    return program_code in self.programs
+
+  def __getitem__(self, program_code) -> RegisteredProgram:
+    return self.programs[program_code]
+
+  def keys(self):
+    return self.programs.keys()
+
+  def values(self):
+    return self.programs.values()
+
+  def items(self):
+    return self.programs.items()
+
+  def variant_rows(self, headings=None) -> Iterator[Tuple[RegisteredProgram, List]]:
+    """ Yield (program, values) for each variant of each program, for bulk export.
+    """
+    getter = _column_getter(tuple(RegisteredProgram._headings if headings is None else headings))
+    for program in self.programs.values():
+      for variant in program.variants.values():
+        yield program, getter(variant)
+
+  def discard(self, program_code):
+    """ Drop a program once it is no longer needed, so its memory can be reclaimed.
+    """
+    self.programs.pop(program_code, None)
+
+  def html_table(self):
+    """ This html table is primarily for testing during development.
+        The transfer app generates html tables from the database info.
+    """
+    return ''.join(html_rows(self.programs.values()))
+
+
+# Streaming output
+# -------------------------------------------------------------------------------------------------
+# The CSV and html writers take any iterable of programs, including a generator that produces them
+# as they are scraped, and yield output a row at a time.
+
+CSV_HEADINGS = ['Program Code', 'Registration Office', 'Formats'] + RegisteredProgram._headings
+
+
+def csv_rows(programs: Iterable[RegisteredProgram], headings=True) -> Iterator[List]:
+  """ Yield the CSV heading row (optionally), then one row for each variant of each program.
+  """
+  if headings:
+    yield CSV_HEADINGS
+  getter = _column_getter(tuple(RegisteredProgram._headings))
+  for program in programs:
+    prefix = [program.program_code, program.unit_code, program.formats]
+    for variant in program.variants.values():
+      yield prefix + getter(variant)
+
+
+HTML_TABLE_HEAD = ('<style>.variant {background-color:#fcc;}</style><table>'
+                   '  <tr><th>Program Code</th><th>Registered By</th>'
+                   """<th><a href="http://www.nysed.gov/college-university-evaluation/format-definitions">
+                Formats</a></th>"""
+                   + ''.join([f'<th>{head}</th>' for head in RegisteredProgram._headings])
+                   + '</tr>\n')
+HTML_TABLE_TAIL = '</table>'
+
+
+def html_rows(programs: Iterable[RegisteredProgram], table=True) -> Iterator[str]:
+  """ Yield a html table a row at a time: the table head (optionally), one row for each variant of
+      each program, and the closing tag (if the head was yielded). Variant rows have the “variant”
+      class when a program has more than one.
+  """
+  if table:
+    yield HTML_TABLE_HEAD
+  getter = _column_getter(tuple(RegisteredProgram._headings))
+  for program in programs:
+    which_class = 'variant' if len(program.variants) > 1 else ''
+    for variant_tuple, variant in program.variants.items():
+      this_class = (which_class + f' {variant_tuple}').strip()
+      yield (f"""  <tr class="{this_class}">
+        <th>{program.program_code}</th><td>{program.unit_code}</td><td>{program.formats}</td>"""
+             + ''.join([f'<td>{cell}</td>' for cell in getter(variant)]) + '</tr>\n')
+  if table:
+    yield HTML_TABLE_TAIL
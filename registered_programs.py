@@ -43,6 +43,11 @@ Design Notes
     RegisteredProgram codes and HEGIS codes look like integers and floats respectively, but are kept
     as strings because that is how they arrive and that is how they are always used/displayed.
 
+    The Phase I list and each program completed in Phase II are checkpointed to disk (see
+    checkpoint.py), so a run that dies part way through can be continued with --resume instead of
+    fetching every institution’s pages again. Checkpoints left by a different run (see --run_id)
+    are not resumed.
+
 """
 import argparse
 import csv
@@ -54,29 +59,48 @@ import socket
 import sys
 
 
+from checkpoint import Checkpoint, DEFAULT_CHECKPOINT_DIR, default_run_id
 from datetime import date
+from detail_parser import (parse_detail_page, DetailParseError, ProgramLine, MultiInstitution,
+                           NotGranting, ForAward, Certificate, Financial, Accreditation, Dates)
+from institution_index import InstitutionIndex
 from lxml.html import document_fromstring
-from registered_program import RegisteredProgram
+from metrics import CountingCursor, metrics, save_on_exit
+from nysed_fetch import PROGRAMS_URL, configure, fetch_details, fetch_page
+from page_cache import CacheMiss, DEFAULT_CACHE_DIR, PageCache
+from registered_program import (CSV_HEADINGS, HTML_TABLE_HEAD, HTML_TABLE_TAIL, ProgramRegistry,
+                                csv_rows, html_rows)
+from registered_programs_db import replace_institution, upsert_institution
 from psycopg.rows import namedtuple_row
 from sendemail import send_message
 
 known_institutions = dict()
-with psycopg.connect(dbname='cuny_curriculum') as conn:
+institution_index = None
+
+
+def load_known_institutions(conn=None):
+  """(Re-)load known_institutions and institution_index from the nys_institutions table, using
+  conn if one is given.
+  """
+  global institution_index
+  if conn is None:
+    with psycopg.connect(dbname='cuny_curriculum', cursor_factory=CountingCursor) as conn:
+      return load_known_institutions(conn)
   with conn.cursor(row_factory=namedtuple_row) as cursor:
-    cursor.execute("select * from nys_institutions")
-    known_institutions = {row.id: (row.institution_id, row.institution_name, row.is_cuny)
-                          for row in cursor.fetchall()}
+    # CUNY colleges also appear under their numeric NYSED ids; their three-letter ids must come
+    # first so that institution_index resolves names to them.
+    cursor.execute("select * from nys_institutions order by not is_cuny, id")
+    rows = cursor.fetchall()
+  known_institutions.clear()
+  known_institutions.update({row.id: (row.institution_id, row.institution_name, row.is_cuny)
+                             for row in rows})
+  institution_index = InstitutionIndex(known_institutions)
 
 
-def detail_lines(all_lines, debug=False):
-  """Filter out unwanted lines from a details web page for a program code; yield the others."""
-  lines = all_lines.splitlines()
-  for line in lines:
-    if re.search(r'^\s+\d{5}\s+|FOR AWARD|PROGRAM|CERTIFICATE|M/A|M/I', line):
-      next_line = line.replace('<H4><PRE>', '').strip()
-      if debug:
-        print(next_line)
-      yield next_line
+load_known_institutions()
+
+# Buffer size for the CSV output file.
+OUTPUT_BUFFER_SIZE = 1 << 16
 
 
 def fix_title(str):
@@ -93,10 +117,131 @@ def fix_title(str):
              .replace(' Of ', ' of '))
 
 
-def lookup_programs(institution, verbose=False, debug=False):
+def fetch_failed(err):
+  """Report a failed request to NYSED and exit."""
+  send_message([{'name': 'Christopher Vickery', 'email': 'cvickery@qc.cuny.edu'}],
+               {'name': 'Transfer App', 'email': 'cvickery@qc.cuny.edu'},
+               f'Registered Programs Update Failed on {socket.gethostname()}',
+               f'<p>{err}</p>')
+  exit(f'{__file__}: ERROR: {socket.gethostname()} {err}')
+
+
+def reporting_failures(pages):
+  """Pass (program_code, page) pairs through, reporting a failed fetch if one occurs."""
+  try:
+    yield from pages
+  except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+    fetch_failed(err)
+  except CacheMiss as err:
+    sys.exit(f'Replay failed: {err}')
+
+
+def lookup_programs(institution, verbose=False, debug=False, workers=1, rate=None, cache=None,
+                    shared_pages=None):
   """Scrape info about programs registered with NYS from the Department of Education website.
 
-  Create a RegisteredProgram object for each program_code.
+  Return a ProgramRegistry with a RegisteredProgram for each program_code. Phase II detail pages
+  are fetched by up to workers concurrent requests, at most rate per second, but are parsed in
+  program code order. If a PageCache is given, pages are taken from it when possible, and saved to
+  it otherwise.
+
+  Each call returns a new registry, so an institution’s programs can be released once its results
+  have been saved. When several institutions are looked up in one run, pass the same shared_pages
+  dict to each call: detail pages of multi-institution programs are saved there, and are not
+  fetched again for the other institutions.
+  """
+  programs = ProgramRegistry()
+  for _ in scrape_programs(institution, programs, verbose=verbose, debug=debug, workers=workers,
+                           rate=rate, cache=cache, shared_pages=shared_pages):
+    pass
+  return programs
+
+
+def read_program_list(institution, programs, verbose=False, debug=False, cache=None):
+  """Phase I: add the institution’s programs to the registry, with the title, award, hegis code,
+  unit code, and formats of each.
+  """
+  institution_id, institution_name, is_cuny = known_institutions[institution]
+
+  # Phase I: Get the program code, title, award, hegis, and unit code for all programs
+  # registered for the institution.
+  with metrics.phase('phase_1'):
+    if verbose:
+      print(f'Fetching list of registered programs for {institution_name} ...', file=sys.stderr)
+    try:
+      url = PROGRAMS_URL
+      page = fetch_page(url, data={'SEARCHES': '1', 'instid': f'{institution_id}'}, cache=cache)
+      html_document = document_fromstring(page.content)
+      h4s = [h4.text_content() for h4 in html_document.cssselect('h4')]
+      metrics.count('rows_parsed', len(h4s))
+      if len(h4s) < 4:
+        raise ValueError(f'Got {len(h4s)} H4 elements from {url} for {institution}')
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ValueError) as err:
+      fetch_failed(err)
+    except CacheMiss as err:
+      sys.exit(f'Replay failed: {err}')
+
+    # The program codes and unit codes are inside H4 elements, in the following sequence:
+    #   PROGRAM CODE  : 36256 - ...
+    #   PROGRAM TITLE : [title text] AWARD : [award text]
+    #   INST.NAME/CITY .[name and address, ignored].. HEGIS : [hegis string for this award]
+    #   FORMATS ... (Not always present.)
+    #   UNIT CODE     : OCUE|OP
+    this_award = None
+    for h4 in h4s:
+      if debug:
+        print(h4)
+      matches = re.search(r'PROGRAM CODE\s+:\s+(\d+) -.+'
+                          r'PROGRAM TITLE\s+:\s+(.+)AWARD : (\S+\s?\S*)', h4)
+      if matches:
+        program_code = matches.group(1)
+        program = programs.program(program_code)
+        this_title = fix_title(matches.group(2))
+        this_award = matches.group(3).strip()
+        continue
+
+      matches = re.search(r'HEGIS : (\S+)', h4)
+      if matches:
+        this_hegis = matches.group(1)
+
+        # The institution should match the one that was requested.
+        this_institution = institution_index.find_in(h4)
+        if this_institution is None:
+          sys.exit(f'Unknown institution in {h4}')
+
+        if this_institution != institution:
+          print(f'h4 wrong institution: {this_institution} is not {institution}\n{h4}. Ignored')
+          continue
+
+        program.new_variant(this_award, this_hegis, this_institution, title=this_title)
+        continue
+
+      if 'UNIT CODE' in h4:
+        matches = re.match(r'\s*UNIT CODE\s*:\s*(.+)\s*', h4)
+        assert matches is not None, f'\nUnrecognized unit code line: {h4}'
+        program.unit_code = matches.group(1).strip()
+        continue
+
+      # The formats information, like the program and unit codes, applies to all variants
+      if 'FORMATS' in h4:
+        matches = re.match(r'\s*FORMATS\s*:\s*(.+)\s*', h4)
+        assert matches is not None, f'\nUnrecognized formats line: {h4}'
+        program.formats = matches.group(1).strip()
+        continue
+
+
+def scrape_programs(institution, programs, verbose=False, debug=False, workers=1, rate=None,
+                    cache=None, shared_pages=None, keep=True, checkpoint=None, resume=False):
+  """Generator behind lookup_programs(): fill the programs registry for the institution, and yield
+  each program as soon as its details have been parsed, so output can start before the rest of the
+  institution’s detail pages have been fetched.
+
+  Unless keep is True, each program is dropped from the registry after it has been yielded, so
+  that the memory needed does not grow with the number of programs.
+
+  If a Checkpoint is given, the Phase I list and each program completed in Phase II are recorded
+  in it. With resume, the programs are restored from the checkpoint, if there is one, instead of
+  being fetched again: completed programs are yielded first, and Phase II continues with the rest.
   """
   try:
     institution_id, institution_name, is_cuny = known_institutions[institution]
@@ -107,85 +252,28 @@ def lookup_programs(institution, verbose=False, debug=False):
     else:
       sys.exit(f'Unrecognized institution: {institution}.')
 
-  # Phase I: Get the program code, title, award, hegis, and unit code for all programs
-  # registered for the institution.
-  if verbose:
-    print(f'Fetching list of registered programs for {institution_name} ...', file=sys.stderr)
-  try:
-    url = 'https://www2.nysed.gov/coms/rp090/IRPS2A'
-    r = requests.post(url, data={'SEARCHES': '1', 'instid': f'{institution_id}'})
-    html_document = document_fromstring(r.content)
-    h4s = [h4.text_content() for h4 in html_document.cssselect('h4')]
-    if len(h4s) < 4:
-      raise ValueError(f'Got {len(h4s)} H4 elements from {url} for {institution}')
-  except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ValueError) as err:
-    send_message([{'name': 'Christopher Vickery', 'email': 'cvickery@qc.cuny.edu'}],
-                 {'name': 'Transfer App', 'email': 'cvickery@qc.cuny.edu'},
-                 f'Registered Programs Update Failed on {socket.gethostname()}',
-                 f'<p>{err}</p>')
-    exit(f'{__file__}: ERROR: {socket.gethostname()} {err}')
-
-  # The program codes and unit codes are inside H4 elements, in the following sequence:
-  #   PROGRAM CODE  : 36256 - ...
-  #   PROGRAM TITLE : [title text] AWARD : [award text]
-  #   INST.NAME/CITY .[name and address, ignored].. HEGIS : [hegis string for this award]
-  #   FORMATS ... (Not always present.)
-  #   UNIT CODE     : OCUE|OP
-  this_award = None
-  for h4 in h4s:
-    if debug:
-      print(h4)
-    matches = re.search(r'PROGRAM CODE\s+:\s+(\d+) -.+PROGRAM TITLE\s+:\s+(.+)AWARD : (\S+\s?\S*)',
-                        h4)
-    if matches:
-      program_code = matches.group(1)
-      program = RegisteredProgram(program_code)
-      this_title = fix_title(matches.group(2))
-      this_award = matches.group(3).strip()
-      continue
-
-    matches = re.search(r'HEGIS : (\S+)', h4)
-    if matches:
-      this_hegis = matches.group(1)
-
-      # The institution should match the one that was requested.
-      this_institution = None
-      for inst in known_institutions.keys():
-        if known_institutions[inst][1] in h4:
-          this_institution = inst
-          break
-      if this_institution is None:
-        sys.exit(f'Unknown institution in {h4}')
-
-      if this_institution != institution:
-        print(f'h4 wrong institution: {this_institution} is not {institution}\n{h4}. Ignored')
-        continue
-
-      program.new_variant(this_award, this_hegis, this_institution, title=this_title)
-      continue
-
-    if 'UNIT CODE' in h4:
-      matches = re.match(r'\s*UNIT CODE\s*:\s*(.+)\s*', h4)
-      assert matches is not None, f'\nUnrecognized unit code line: {h4}'
-      program.unit_code = matches.group(1).strip()
-      continue
-
-    # The formats information, like the program and unit codes, applies to all variants
-    if 'FORMATS' in h4:
-      matches = re.match(r'\s*FORMATS\s*:\s*(.+)\s*', h4)
-      assert matches is not None, f'\nUnrecognized formats line: {h4}'
-      program.formats = matches.group(1).strip()
-      continue
+  restored = None
+  if checkpoint is not None and resume:
+    restored = checkpoint.load(programs)
+  if restored is None:
+    read_program_list(institution, programs, verbose=verbose, debug=debug, cache=cache)
+    if checkpoint is not None:
+      checkpoint.start(programs)
+  else:
+    checkpoint.resume()
+    if verbose:
+      print(f'Resuming {institution_name}: {len(restored.completed)} of {len(programs)} programs '
+            f'already done.', file=sys.stderr)
 
   if verbose:
-    num_programs = len(RegisteredProgram.programs)
+    num_programs = len(programs)
     len_num = len(str(num_programs))
     print(f'Found {num_programs} registered programs.', file=sys.stderr)
     print('Fetching details...', file=sys.stderr)
 
   if debug:
-    for p in RegisteredProgram.programs:
-      program = RegisteredProgram.programs[p]
+    for p in programs:
+      program = programs[p]
       print(program.program_code, program.unit_code)
       for v in program.variants:
         print(v, program.values(v))
@@ -197,173 +285,190 @@ def lookup_programs(institution, verbose=False, debug=False):
   # * A for-award line followed by detail lines for that award. There will be one or more for-award
   #   groups. The details get applied to all variants that include the specified award.
   #
-  # The following code tests lines in the sequence in which they appear on the details web page.
-  # This is to reduce cognitive load: the tests for line types could be done in any order and the
-  # actual sequence of lines on the details page would make it all work out.
-
-  programs_counter = 0  # For progress reporting in verbose mode
-  for p in RegisteredProgram.programs:
-    program = RegisteredProgram.programs[p]
-    programs_counter += 1
-    if verbose and os.isatty(sys.stdout.fileno()):
-      print(f'Registered Program code: {p} ({programs_counter:{len_num}}/{num_programs})\r',
-            end='', file=sys.stderr)
-
-    for_award = None
-    try:
-      r = requests.get(f'https://www2.nysed.gov/COMS/RP090/IRPSL3?PROGCD={program.program_code}')
-    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
-      send_message([{'name': 'Christopher Vickery', 'email': 'cvickery@qc.cuny.edu'}],
-                   {'name': 'Transfer App', 'email': 'cvickery@qc.cuny.edu'},
-                   f'Registered Programs Update Failed on {socket.gethostname()}',
-                   f'<p>{err}</p>')
-      exit(f'{__file__}: ERROR: {socket.gethostname()} {err}')
-
-    # There was a web page that had a 0x1e in the middle of a string of blanks (program code 31441
-    # at CSI), and splitlines() uses this as one of the line boundaries ((Record Separator)), which
-    # broke the first re.match operation below. There is no option for changing the behavior of the
-    # splitlines builtin, so we delete the stray character from all web pages retrieved. By rights,
-    # we should also be deleting \v, \f, \x1c, \x1d, \x85, \u2028, and \u2029 as well. But we don’t.
-    for line in detail_lines(r.text.replace('\x1e', '')):
-      if debug:
-        print(line)
-      # Use the first token on a line to determine the type of line.
-      tokens = line.split()
-      token = tokens[0]
-
-      # First token is a numeric string (Program Code #.) or Multi-Award (M/A).
-      if token.isdecimal() or token == 'M/A':
-        # Extract program_code, title, hegis_code, award, institution.
-        matches = re.match(r'\s*(\d+|M/A)\s+(.+)(\d{4}\.\d{2})\s+(\S+\s?\S*)\s+(.+)', line)
-        if matches is None:
-          sys.exit(f'\nUnable to parse program code line for program code {program_code}:\n{line}')
-        # Check the title and hegis for the award. Always set the institution.
-        program_title = fix_title(matches.group(2))
-        program_hegis = matches.group(3)
-        program_award = matches.group(4).strip()
-        program_institution = matches.group(5)
-
-        if debug:
-          print(f'Program Code # or M/A line: {program.program_code}: "{program_title}" '
-                f'{program_hegis} {program_award} "{program_institution}"')
-
-        this_institution = None
-        for key in known_institutions.keys():
-          if program_institution == known_institutions[key][1]:
-            this_institution = key
-            break
-        assert this_institution is not None, f'\n{this_institution}\n{line}'
-
-        # Create this variant if necessary (Never used)
-        # this_variant = program.new_variant(program_award, program_hegis, this_institution,
-        #                                    title=program_title)
-        continue
-
-      if token == 'M/I':
-        # Multi-Institution: extract hegis, award, institution
-        if 'NOT-GRANTING' in line:
-          # If the award is NOT-GRANTING, then variants for this award-institution pair have to be
-          # removed.
-          matches = re.search(r'NOT-GRANTING\s+(.+)', line)
-          if matches is None:
-            sys.exit(f'\nUnable to parse M/I line for program code {program.program_code}:{line}')
-          this_institution = matches.group(1).strip()
-          for inst in known_institutions:
-            if this_institution == known_institutions[inst][1]:
-              for variant_tuple in list(program.variants.keys()):
-                if variant_tuple[0] == program_award and variant_tuple[2] == inst:
-                  program.variants.pop(variant_tuple, None)
-                  if debug:
-                    print(f'Deleted tuple {variant_tuple}')
-        else:
-          matches = re.search(r'(\d{4}.\d{2})\s+(\S+\s?\S*)\s+(.*)', line)
-          if matches is None:
-            sys.exit(f'\nUnable to parse M/I line for program code {program.program_code}:{line}')
-          program_hegis = matches.group(1)
-          program_award = matches.group(2).strip()
-          program_institution_name = matches.group(3).strip()
-          program_institution = None
-          for inst in known_institutions:
-            if program_institution_name == known_institutions[inst][1]:
-              program_institution = inst
-              break
-          assert program_institution is not None, 'Unrecognized institution {} in {}'.format(
-              program_institution_name, line)
-
-          # Create this variant if necessary
-          variant = program.new_variant(program_award, program_hegis, program_institution)
+  # The page is parsed into records by detail_parser; see there for how lines are classified.
+
+  with metrics.phase('phase_2'):
+    completed = restored.completed if restored is not None else []
+    done = set(completed)
+    to_fetch = [p for p in programs.keys() if p not in done]
+    for p in completed:
+      yield programs[p]
+      if not keep:
+        programs.discard(p)
+
+    programs_counter = len(completed)  # For progress reporting in verbose mode
+    program_award = None
+    details = fetch_details(to_fetch, workers=workers, rate=rate,
+                            cache=cache, pages=shared_pages)
+    for p, page in reporting_failures(details):
+      program = programs[p]
+      programs_counter += 1
+      if verbose and os.isatty(sys.stdout.fileno()):
+        print(f'Registered Program code: {p} ({programs_counter:{len_num}}/{num_programs})\r',
+              end='', file=sys.stderr)
+
+      variant_tuples = []
+      num_records = 0
+      if shared_pages is not None and 'M/I' in page:
+        shared_pages[p] = page
+
+      try:
+        for line, record in parse_detail_page(page):
+          num_records += 1
           if debug:
-            print(variant)
-        continue
+            print(line)
+
+          if isinstance(record, ProgramLine):
+            # Program Code # or Multi-Award (M/A) line. Check the title and hegis for the award.
+            # Always set the institution.
+            program_title = fix_title(record.title)
+            program_hegis = record.hegis
+            program_award = record.award
+            program_institution = record.institution
+
+            if debug:
+              print(f'Program Code # or M/A line: {program.program_code}: "{program_title}" '
+                    f'{program_hegis} {program_award} "{program_institution}"')
+
+            this_institution = institution_index.exact(program_institution)
+            assert this_institution is not None, f'\n{this_institution}\n{line}'
+
+            # Create this variant if necessary (Never used)
+            # this_variant = program.new_variant(program_award, program_hegis, this_institution,
+            #                                    title=program_title)
+
+          elif isinstance(record, NotGranting):
+            # If the award is NOT-GRANTING, then variants for this award-institution pair have to be
+            # removed.
+            for inst in institution_index.all_named(record.institution):
+              for variant_tuple in program.remove_variants(program_award, inst):
+                if debug:
+                  print(f'Deleted tuple {variant_tuple}')
+
+          elif isinstance(record, MultiInstitution):
+            program_hegis = record.hegis
+            program_award = record.award
+            program_institution = institution_index.exact(record.institution)
+            assert program_institution is not None, 'Unrecognized institution {} in {}'.format(
+                record.institution, line)
+
+            # Create this variant if necessary
+            variant = program.new_variant(program_award, program_hegis, program_institution)
+            if debug:
+              print(variant)
+
+          elif isinstance(record, ForAward):
+            # Select the variant_tuples that will be affected by the detail lines that follow.
+            for_award = record.award
+            variant_tuples = program.award_variants(for_award)
+            if debug:
+              for variant in variant_tuples:
+                print(variant)
+
+          # Detail lines for the currently-identified award.
+          elif isinstance(record, Certificate):
+            for variant_tuple in variant_tuples:
+              if debug:
+                print(f'Update {variant_tuple} with cert info “{record.text}”')
+              program.variants[variant_tuple].certificate_license = record.text
+
+          elif isinstance(record, Financial):
+            for variant_tuple in variant_tuples:
+              if debug:
+                print(f'Update {variant_tuple} with: {record.tap} {record.apts} {record.vvta}')
+              program.variants[variant_tuple].tap = record.tap
+              program.variants[variant_tuple].apts = record.apts
+              program.variants[variant_tuple].vvta = record.vvta
+
+          elif isinstance(record, Accreditation):
+            for variant_tuple in variant_tuples:
+              if debug:
+                print(f'Update {variant_tuple} with accreditiation: “{record.text}”')
+              program.variants[variant_tuple].accreditation = record.text
+
+          elif isinstance(record, Dates):
+            first_date = record.first_registration
+            last_date = record.last_action
+            for variant_tuple in variant_tuples:
+              if debug:
+                print(f'Update {variant_tuple} with dates: {first_date} {last_date}')
+              if (program.variants[variant_tuple].first_registration_date is None
+                  or first_date.replace('PRE-', '19')
+                  < program.variants[variant_tuple].first_registration_date):
+                program.variants[variant_tuple].first_registration_date = first_date
+              if (program.variants[variant_tuple].last_registration_action is None
+                  or last_date > program.variants[variant_tuple].last_registration_action):
+                program.variants[variant_tuple].last_registration_action = last_date
+
+      except DetailParseError as err:
+        sys.exit(f'\nProgram code {program.program_code}: {err}')
+
+      metrics.count('rows_parsed', num_records)
+      if checkpoint is not None:
+        checkpoint.program_done(program)
+      yield program
+      if not keep:
+        programs.discard(p)
 
-      if token == 'FOR':
-        # Extract award, and use it to select variant_tuples that will be affected by detail lines
-        # that follow.
-        for_award = re.match(r'\s*FOR AWARD\s*--(.*)', line).group(1).strip()
-        variant_tuples = [variant_tuple for variant_tuple in program.variants
-                          if variant_tuple[0] == for_award]
-        if debug:
-          for variant in variant_tuples:
-            print(variant)
-
-      # Detail lines for the currently-identified award.
-      if token.startswith('CERTIFICATE') and for_award is not None:
-        # Extract certificate tuple {name, type, date} if there is one.
-        cert_info = re.sub(r'\s+', ' ', line.split(':')[1].strip())
-        if cert_info.startswith('NONE'):
-          cert_info = ''
-        for variant_tuple in variant_tuples:
-          if debug:
-            print(f'Update {variant_tuple} with cert info “{cert_info}”')
-          program.variants[variant_tuple].certificate_license = cert_info
-        continue
+  if verbose:
+    print('\r')
+    if cache is not None:
+      print(f'Page cache: {cache.hits} hits; {cache.misses} misses', file=sys.stderr)
 
-      if token == 'PROGRAM' and tokens[1] == 'FINANCIAL' and for_award is not None:
-        # Extract three booleans.
-        matches = re.search(r'(YES|NO).+(YES|NO).+(YES|NO)', line)
-        if matches is None:
-          sys.exit(f'\nUnable to parse eligibility line for program code {program_code}:\n{line}')
-        for variant_tuple in variant_tuples:
-          if debug:
-            print('Update {} with: {} {} {}'.format(variant_tuple,
-                                                    matches.group(1),
-                                                    matches.group(2),
-                                                    matches.group(3)))
-          program.variants[variant_tuple].tap = matches.group(1)
-          program.variants[variant_tuple].apts = matches.group(2)
-          program.variants[variant_tuple].vvta = matches.group(3)
-        continue
 
-      if token == 'PROGRAM' and tokens[1] == 'PROFESSIONAL' and for_award is not None:
-        # Extract text, if any.
-        program_accreditation = line.split(':')[1].strip()
-        for variant_tuple in variant_tuples:
-          if debug:
-            print(f'Update {variant_tuple} with accreditiation: “{program_accreditation}”')
-          program.variants[variant_tuple].accreditation = program_accreditation
-        continue
+def streamed_outputs(institution, programs, args):
+  """Write the CSV file and/or html table requested on the command line for one institution’s
+  programs, an iterable that may be a generator producing them as they are scraped. Each program is
+  written as it arrives, and passed on to the caller.
+  """
+  csv_file = csv_writer = None
+  if args.csv:
+    # Generate spreadsheet
+    #   Apple Numbers does a better job than Microsoft Excel at opening the CSV file.
+    #   For Excel, it’s better to import it.
+    file_name = institution.upper() + '_' + date.today().isoformat() + '.csv'
+    csv_file = open(file_name, 'w', newline='', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE)
+    csv_writer = csv.writer(csv_file)
+    csv_writer.writerow(CSV_HEADINGS)
+  if args.html:
+    # Generate a HTML table element. Add CSS to highlight rows that have the “variant” class.
+    sys.stdout.write(HTML_TABLE_HEAD)
+  try:
+    for program in programs:
+      if csv_writer is not None:
+        csv_writer.writerows(csv_rows((program, ), headings=False))
+      if args.html:
+        sys.stdout.writelines(html_rows((program, ), table=False))
+      yield program
+    if args.html:
+      sys.stdout.write(HTML_TABLE_TAIL + '\n')
+  finally:
+    if csv_file is not None:
+      csv_file.close()
+
+
+def write_institution(conn, institution, programs, incremental=False):
+  """Update the registered_programs table with one institution’s programs, using conn."""
+  # See registered_programs.sql for the schema of the table, which must already exist.
+  with metrics.phase('db_write'):
+    if incremental:
+      counts = upsert_institution(conn, institution, programs)
+      metrics.count('rows_written', counts.inserted + counts.updated + counts.deleted)
+      print(f'Updated {institution.upper()} for {len(programs)} programs: '
+            f'{counts.inserted} inserted; {counts.updated} updated; {counts.deleted} deleted; '
+            f'{counts.unchanged} unchanged.')
+    else:
+      num_deleted, num_inserted = replace_institution(conn, institution, programs)
+      metrics.count('rows_written', num_deleted + num_inserted)
+      print(f'Replaced {num_deleted} entries for {institution.upper()} with {num_inserted} '
+            f'entries for {len(programs)} programs.')
 
-      if token == 'PROGRAM' and tokens[1] == 'FIRST' and for_award is not None:
-        matches = re.search(r'DATE:\s+(\S+).+ACTION:\s+(\S+)', line)
-        if matches is None:
-          sys.exit('\nUnable to parse registration dates for program code {}:\n{}'
-                   .format(program.program_code, line))
-        first_date = matches[1]
-        last_date = matches[2]
-        for variant_tuple in variant_tuples:
-          if debug:
-            print(f'Update {variant_tuple} with dates: {first_date} {last_date}')
-          if (program.variants[variant_tuple].first_registration_date is None
-              or first_date.replace('PRE-', '19')
-              < program.variants[variant_tuple].first_registration_date):
-            program.variants[variant_tuple].first_registration_date = first_date
-          if (program.variants[variant_tuple].last_registration_action is None
-              or last_date > program.variants[variant_tuple].last_registration_action):
-            program.variants[variant_tuple].last_registration_action = last_date
 
-  if verbose:
-    print('\r')
-  return RegisteredProgram.programs
+def save_results(institution, programs, args):
+  """Update the registered_programs table with one institution’s programs, if requested."""
+  if args.update_db:
+    with psycopg.connect('dbname=cuny_curriculum', cursor_factory=CountingCursor) as conn:
+      write_institution(conn, institution, programs, incremental=args.incremental)
 
 
 """ Command Line Interface
@@ -372,71 +477,103 @@ if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='''
                                    Scrape the NYS Department of Education website for information
                                    about academic programs registered for CUNY colleges.''')
-  parser.add_argument('institution')
+  parser.add_argument('institutions', nargs='*', metavar='institution')
+  parser.add_argument('-a', '--all', action='store_true', default=False,
+                      help='process all CUNY institutions')
   parser.add_argument('-u', '--update_db', action='store_true', default=False,
-                      help='update info for this institution in the registered_programs database')
+                      help='update info for these institutions in the registered_programs database')
+  parser.add_argument('-i', '--incremental', action='store_true', default=False,
+                      help='with -u, change only the rows that were added, changed, or dropped')
   parser.add_argument('-w', '--html', action='store_true', default=False,
                       help='generate a html table suitable for the web')
   parser.add_argument('-c', '--csv', action='store_true', default=False,
                       help='generate a CSV table')
   parser.add_argument('-d', '--debug', action='store_true', default=False)
   parser.add_argument('-v', '--verbose', action='store_true', default=False)
+  parser.add_argument('--workers', type=int, default=1,
+                      help='number of program detail pages to fetch concurrently (default 1)')
+  parser.add_argument('--rate', type=float, default=None,
+                      help='maximum requests per second to NYSED (default no limit, except while '
+                           'NYSED is slow or failing)')
+  parser.add_argument('--timeout', type=float, default=120.0, metavar='SECONDS',
+                      help='give up on a request after this long (default 120)')
+  parser.add_argument('--retries', type=int, default=4,
+                      help='retry a failed request up to this many times (default 4)')
+  parser.add_argument('--deadline', type=float, default=None, metavar='MINUTES',
+                      help='fail any request made after the run has lasted this long '
+                           '(default none)')
+  parser.add_argument('--cache', nargs='?', const=DEFAULT_CACHE_DIR, default=None, metavar='DIR',
+                      help=f'cache NYSED pages on disk (default dir {DEFAULT_CACHE_DIR.name})')
+  parser.add_argument('--cache_ttl', type=float, default=12.0, metavar='HOURS',
+                      help='re-fetch cached pages older than this (default 12)')
+  parser.add_argument('--cache_size', type=int, default=500, metavar='MB',
+                      help='evict oldest cached pages beyond this size (default 500)')
+  parser.add_argument('--replay', action='store_true', default=False,
+                      help='parse only pages from the cache, without going to NYSED')
+  parser.add_argument('--resume', action='store_true', default=False,
+                      help='continue an interrupted run from its checkpoints')
+  parser.add_argument('--checkpoint_dir', default=DEFAULT_CHECKPOINT_DIR, metavar='DIR',
+                      help=f'where to keep checkpoints (default dir {DEFAULT_CHECKPOINT_DIR.name})')
+  parser.add_argument('--run_id', default=default_run_id(),
+                      help='identifies the run in its checkpoints; --resume uses only checkpoints '
+                           'with the same run_id (default today’s date)')
   args = parser.parse_args()
+  save_on_exit(__file__)
 
   if not args.debug and not args.csv and not args.html and not args.update_db:
     sys.exit('No output options: nothing to do.')
 
   # Institution ID is a six-digit numeric string or, for CUNY, three letters followed by an optional
   # 01.
-  if len(args.institution) < 6:
-    institution = args.institution.lower().strip('10')
-  else:
-    institution = args.institution
-
-  programs = lookup_programs(institution, debug=args.debug, verbose=args.verbose)
-  if programs is not None:
-
-    if args.csv:
-      # Generate spreadsheet
-      #   Apple Numbers does a better job than Microsoft Excel at opening the CSV file.
-      #   For Excel, it’s better to import it.
-      file_name = institution.upper() + '_' + date.today().isoformat() + '.csv'
-      with open(file_name, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['Program Code', 'Registration Office', 'Formats']
-                        + RegisteredProgram._headings)
-        for p in RegisteredProgram.programs:
-          program = programs[p]
-          for program_variant in program.variants:
-            writer.writerow([program.program_code, program.unit_code, program.formats]
-                            + program.values(program_variant))
-
-    if args.html:
-      # Generate a HTML table element. Add CSS to highlight rows that have the “variant” class.
-      print(RegisteredProgram.html_table())
-
-    if args.update_db:
-      # See registered_programs.sql for the schema of the table, which must already exist.
-      with psycopg.connect('dbname=cuny_curriculum') as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cursor:
-          cursor.execute('delete from registered_programs where target_institution=%s',
-                         (institution,))
-          print('Replacing {} entries for {} with info for {} programs.'
-                .format(cursor.rowcount, institution.upper(), len(RegisteredProgram.programs)))
-          for p in RegisteredProgram.programs:
-            program = programs[p]
-            is_variant = len(program.variants) > 1
-            for program_variant in program.variants:
-              values = [institution, program.program_code, program.unit_code]
-              values += program.values(program_variant)
-              values += [is_variant]
-              values.insert(6, program.formats)
-              # deal with nul bytes from NYS
-              for i in range(len(values)):
-                if type(values[i]) is str:
-                  values[i] = values[i].replace('\x00', '')
-              cursor.execute(f'insert into registered_programs values('
-                             f"{', '.join(['%s'] * len(values))})", values)
+  institutions = []
+  if args.all:
+    institutions = sorted(inst for inst in known_institutions if known_institutions[inst][2])
+  for arg in args.institutions:
+    if len(arg) < 6:
+      institution = arg.lower().strip('10')
+    else:
+      institution = arg
+    if institution not in institutions:
+      institutions.append(institution)
+  if len(institutions) == 0:
+    sys.exit('No institutions: nothing to do.')
+
+  configure(rate=args.rate, request_timeout=args.timeout, retries=args.retries,
+            deadline=None if args.deadline is None else args.deadline * 60)
+
+  cache = None
+  if args.cache is not None or args.replay:
+    cache = PageCache(args.cache or DEFAULT_CACHE_DIR,
+                      ttl=args.cache_ttl * 3600,
+                      max_bytes=args.cache_size * 1024 * 1024,
+                      replay=args.replay)
+
+  # Detail pages for programs shared by more than one institution (M/I programs) are kept here so
+  # that each one is fetched just once per run.
+  shared_pages = dict()
+  checkpoints = []
+  for institution in institutions:
+    # Progress is checkpointed so that an interrupted run can be continued with --resume.
+    # Institutions whose results were saved are skipped; the others pick up where they left off.
+    checkpoint = Checkpoint(institution, args.checkpoint_dir, args.run_id)
+    checkpoints.append(checkpoint)
+    if args.resume and checkpoint.is_done():
+      if args.verbose:
+        print(f'{institution}: already done.', file=sys.stderr)
+      continue
 
-  else:
-    sys.exit('lookup_programs failed')
+    # CSV and html output is written as each program is scraped. The programs are kept for the
+    # database update only if there is to be one.
+    with metrics.phase(institution):
+      programs = ProgramRegistry()
+      scraped = scrape_programs(institution, programs, debug=args.debug, verbose=args.verbose,
+                                workers=args.workers, cache=cache, shared_pages=shared_pages,
+                                keep=args.update_db, checkpoint=checkpoint, resume=args.resume)
+      for program in streamed_outputs(institution, scraped, args):
+        pass
+      save_results(institution, programs, args)
+      checkpoint.finish()
+
+  # Every institution completed: the checkpoints are no longer needed.
+  for checkpoint in checkpoints:
+    checkpoint.remove()
@@ -21,8 +21,14 @@ create table registered_programs (
   is_variant                boolean default False,
   html                      text default '',
   csv                       text default '',
+  content_hash              text,
+  html_fingerprint          text,
   primary key (target_institution, institution, program_code, award, hegis)
 );
 
+-- To add the content_hash column to an existing table without dropping it:
+--   alter table registered_programs add column if not exists content_hash text;
+-- and likewise for html_fingerprint, which generate_html.py uses.
+
 -- Be sure there is an entry for it in the updates table.
 insert into updates values ('registered_programs') on conflict do nothing;
@@ -0,0 +1,172 @@
+""" Write scraped RegisteredProgram variants to the registered_programs table.
+
+    See registered_programs.sql for the schema of the table, which must already exist.
+
+    All of an institution’s variants are streamed with COPY into a temporary staging table, and
+    the institution’s rows are then replaced from the staging table in the same transaction. Other
+    sessions see either all of the old rows or all of the new ones, never a partly loaded
+    institution, and a full load takes a handful of round trips instead of one per variant.
+
+    Each row carries a hash of its scraped values. An incremental update uses the hashes to compare
+    the staged rows with the existing ones by primary key: new variants are inserted, changed ones
+    updated, discontinued ones deleted, and unchanged rows (with their html and csv columns) are
+    left alone.
+
+    Writes for an institution hold a transaction-level advisory lock on it, so that processes (or
+    threads) writing the same institution’s rows take turns, while different institutions can be
+    written concurrently.
+"""
+import hashlib
+
+from typing import Dict, Iterator, NamedTuple, Tuple
+
+# Columns written from the scrape, in table order. (The html and csv columns are filled in later
+# by generate_html.py.)
+COLUMNS = ('target_institution',
+           'program_code',
+           'unit_code',
+           'institution',
+           'title',
+           'award',
+           'formats',
+           'hegis',
+           'certificate_license',
+           'accreditation',
+           'first_registration_date',
+           'last_registration_action',
+           'tap', 'apts', 'vvta',
+           'is_variant')
+
+KEY_COLUMNS = ('target_institution', 'institution', 'program_code', 'award', 'hegis')
+VALUE_COLUMNS = tuple(column for column in COLUMNS if column not in KEY_COLUMNS)
+
+
+# First key of the advisory locks on institutions’ rows; the second is hashtext(institution).
+ADVISORY_LOCK_CLASS = 4242
+
+
+class UpsertCounts(NamedTuple):
+  inserted: int
+  updated: int
+  deleted: int
+  unchanged: int
+
+
+def _scrub(value):
+  """ NYS pages sometimes have NUL bytes, which Postgres text cannot hold. """
+  if type(value) is str and '\x00' in value:
+    return value.replace('\x00', '')
+  return value
+
+
+def content_hash(row: Tuple) -> str:
+  """ Hash of a row’s COLUMNS values. """
+  return hashlib.sha1('\x1f'.join(str(value) for value in row).encode()).hexdigest()
+
+
+# program_rows()
+# -------------------------------------------------------------------------------------------------
+def program_rows(institution: str, programs: Dict) -> Iterator[Tuple]:
+  """ Yield a tuple of COLUMNS values for each variant of each program.
+  """
+  for program in programs.values():
+    is_variant = len(program.variants) > 1
+    for variant_tuple in program.variants:
+      (inst, title, award, hegis, certificate_license, accreditation, first_registration_date,
+       last_registration_action, tap, apts, vvta) = program.values(variant_tuple)
+      row = (institution, program.program_code, program.unit_code, inst, title, award,
+             program.formats, hegis, certificate_license, accreditation, first_registration_date,
+             last_registration_action, tap, apts, vvta, is_variant)
+      yield tuple(_scrub(value) for value in row)
+
+
+# _lock_institution()
+# -------------------------------------------------------------------------------------------------
+def _lock_institution(cursor, institution: str):
+  """ Wait for, and hold until the current transaction ends, the institution’s advisory lock.
+  """
+  cursor.execute('select pg_advisory_xact_lock(%s, hashtext(%s))',
+                 (ADVISORY_LOCK_CLASS, institution))
+
+
+# _stage()
+# -------------------------------------------------------------------------------------------------
+def _stage(cursor, institution: str, programs: Dict) -> int:
+  """ COPY the programs’ rows, with their content hashes, into a temporary staging table that is
+      dropped when the current transaction commits. Returns the number of rows staged.
+  """
+  cursor.execute("""
+    create temporary table registered_programs_staging
+      (like registered_programs including defaults)
+      on commit drop
+  """)
+  num_rows = 0
+  with cursor.copy(f'copy registered_programs_staging ({", ".join(COLUMNS)}, content_hash) '
+                   f'from stdin') as copy:
+    for row in program_rows(institution, programs):
+      copy.write_row(row + (content_hash(row), ))
+      num_rows += 1
+  return num_rows
+
+
+# replace_institution()
+# -------------------------------------------------------------------------------------------------
+def replace_institution(conn, institution: str, programs: Dict) -> Tuple[int, int]:
+  """ Atomically replace the institution’s rows with its programs’ variants.
+      Returns the number of rows deleted and the number inserted.
+  """
+  column_list = ', '.join(COLUMNS + ('content_hash', ))
+  with conn.transaction():
+    with conn.cursor() as cursor:
+      _lock_institution(cursor, institution)
+      _stage(cursor, institution, programs)
+      cursor.execute('delete from registered_programs where target_institution = %s',
+                     (institution, ))
+      num_deleted = cursor.rowcount
+      cursor.execute(f"""
+        insert into registered_programs ({column_list})
+        select {column_list} from registered_programs_staging
+      """)
+      num_inserted = cursor.rowcount
+  return num_deleted, num_inserted
+
+
+# upsert_institution()
+# -------------------------------------------------------------------------------------------------
+def upsert_institution(conn, institution: str, programs: Dict) -> UpsertCounts:
+  """ Atomically bring the institution’s rows up to date with its programs’ variants, touching
+      only rows that were added, changed, or discontinued.
+  """
+  key_match = ' and '.join(f'r.{column} = s.{column}' for column in KEY_COLUMNS)
+  column_list = ', '.join(COLUMNS + ('content_hash', ))
+  assignments = ', '.join(f'{column} = s.{column}' for column in VALUE_COLUMNS + ('content_hash', ))
+  with conn.transaction():
+    with conn.cursor() as cursor:
+      _lock_institution(cursor, institution)
+      num_staged = _stage(cursor, institution, programs)
+
+      cursor.execute(f"""
+        delete from registered_programs r
+         where r.target_institution = %s
+           and not exists (select 1 from registered_programs_staging s where {key_match})
+      """, (institution, ))
+      num_deleted = cursor.rowcount
+
+      cursor.execute(f"""
+        update registered_programs r
+           set {assignments}
+          from registered_programs_staging s
+         where {key_match}
+           and r.content_hash is distinct from s.content_hash
+      """)
+      num_updated = cursor.rowcount
+
+      cursor.execute(f"""
+        insert into registered_programs ({column_list})
+        select {column_list} from registered_programs_staging s
+         where not exists (select 1 from registered_programs r where {key_match})
+      """)
+      num_inserted = cursor.rowcount
+
+  return UpsertCounts(num_inserted, num_updated, num_deleted,
+                      num_staged - num_updated - num_inserted)
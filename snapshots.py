@@ -0,0 +1,274 @@
+#! /usr/local/bin/python3
+""" Compressed, deduplicated snapshots of the tables the nightly update rebuilds.
+
+    A snapshot of a table is its rows in binary COPY format, gzipped, in a file named for a hash of
+    the table’s columns and contents. The hash is computed by the server, so when a table has not
+    changed since its last snapshot nothing but the hash crosses the connection and nothing is
+    written. A table that goes back to an earlier state reuses that state’s file.
+
+    manifest.json in the snapshot directory lists each table’s snapshots, oldest first, with the
+    columns needed to re-create the table if it is missing. Restoring a table loads its latest
+    snapshot without scanning the directory. Only the latest KEEP_SNAPSHOTS snapshots of each table
+    are kept.
+
+    Usage:
+      snapshots.py archive [table ...]    Snapshot the tables (default ARCHIVED_TABLES).
+      snapshots.py restore table ...      Restore the tables from their latest snapshots.
+      snapshots.py list                   Show the snapshots in the manifest.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import psycopg
+import sys
+
+from datetime import datetime
+from metrics import CountingCursor, metrics
+from pathlib import Path
+from psycopg import sql
+from psycopg.rows import namedtuple_row
+from typing import Dict, List, NamedTuple, Optional
+
+DEFAULT_SNAPSHOT_DIR = Path(__file__).parent / 'archives'
+
+# Tables that the nightly update rebuilds, and so snapshots first.
+ARCHIVED_TABLES = ('hegis_areas', 'hegis_codes', 'nys_institutions', 'registered_programs')
+
+KEEP_SNAPSHOTS = 10
+
+# Bytes per write when loading a snapshot.
+COPY_BLOCK_SIZE = 1 << 16
+
+
+class SnapshotError(LookupError):
+  """ A table cannot be snapshotted or restored.
+  """
+  pass
+
+
+class SnapshotResult(NamedTuple):
+  table: str
+  status: str       # new, reused (an earlier file), unchanged, or empty (not snapshotted)
+  rows: int
+  bytes: int
+
+  def __str__(self):
+    return f'  {self.table}: {self.status} ({self.rows:,} rows; {self.bytes:,} bytes)'
+
+
+# table_columns()
+# -------------------------------------------------------------------------------------------------
+def table_columns(cursor, table: str) -> List[List]:
+  """ [name, type, not null, default] for each of the table’s columns, in order, or an empty list if
+      there is no such table.
+  """
+  cursor.execute("""
+    select attname, format_type(atttypid, atttypmod) as type, attnotnull,
+           pg_get_expr(adbin, adrelid) as default
+      from pg_attribute
+      left join pg_attrdef on adrelid = attrelid and adnum = attnum
+     where attrelid = to_regclass(%s)
+       and attnum > 0
+       and not attisdropped
+     order by attnum
+  """, (table, ))
+  return [[row.attname, row.type, row.attnotnull, row.default] for row in cursor.fetchall()]
+
+
+def primary_key(cursor, table: str) -> List[str]:
+  """ The columns of the table’s primary key. """
+  cursor.execute("""
+    select attname
+      from pg_index
+      join pg_attribute on attrelid = indrelid and attnum = any(indkey)
+     where indrelid = to_regclass(%s)
+       and indisprimary
+     order by array_position(indkey, attnum)
+  """, (table, ))
+  return [row.attname for row in cursor.fetchall()]
+
+
+# class SnapshotStore
+# -------------------------------------------------------------------------------------------------
+class SnapshotStore(object):
+  """ The snapshot files and their manifest.
+  """
+
+  def __init__(self, snapshot_dir=DEFAULT_SNAPSHOT_DIR, keep: int = KEEP_SNAPSHOTS):
+    self.snapshot_dir = Path(snapshot_dir)
+    self.manifest_file = self.snapshot_dir / 'manifest.json'
+    self.keep = keep
+    try:
+      self.manifest: Dict[str, List[dict]] = json.loads(self.manifest_file.read_text())['tables']
+    except FileNotFoundError:
+      self.manifest = dict()
+
+  def _save_manifest(self):
+    self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = self.manifest_file.with_name(f'manifest.{os.getpid()}.tmp')
+    tmp_file.write_text(json.dumps({'version': 1, 'tables': self.manifest}, indent=2) + '\n')
+    os.replace(tmp_file, self.manifest_file)
+
+  def latest(self, table: str) -> Optional[dict]:
+    """ The manifest entry of the table’s latest snapshot, if there is one. """
+    snapshots = self.manifest.get(table)
+    return snapshots[-1] if snapshots else None
+
+  def snapshot(self, conn, table: str) -> SnapshotResult:
+    """ Snapshot the table, unless its latest snapshot already has the same columns and contents.
+    """
+    with metrics.phase('snapshot'), conn.transaction():
+      with conn.cursor(row_factory=namedtuple_row) as cursor:
+        # The hash and the copy must see the same rows.
+        cursor.execute('set transaction isolation level repeatable read')
+        columns = table_columns(cursor, table)
+        if not columns:
+          raise SnapshotError(f'{table} NOT archived: no table')
+        cursor.execute(sql.SQL("""
+          select count(*) as num_rows,
+                 md5(string_agg(t::text, E'\\n' order by t::text)) as digest
+            from {} t
+        """).format(sql.Identifier(table)))
+        row = cursor.fetchone()
+        if row.num_rows == 0:
+          return SnapshotResult(table, 'empty', 0, 0)
+        content_hash = hashlib.sha256(json.dumps([columns, row.digest]).encode()).hexdigest()
+
+        now = datetime.now().isoformat(timespec='seconds')
+        latest = self.latest(table)
+        if latest is not None and latest['hash'] == content_hash:
+          latest['checked'] = now
+          self._save_manifest()
+          return SnapshotResult(table, 'unchanged', row.num_rows, 0)
+
+        file_name = f'{table}_{content_hash[:20]}.copy.gz'
+        snapshot_file = self.snapshot_dir / file_name
+        if snapshot_file.exists():
+          status = 'reused'
+          num_bytes = 0
+        else:
+          status = 'new'
+          self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+          tmp_file = snapshot_file.with_name(f'{file_name}.{os.getpid()}.tmp')
+          column_list = sql.SQL(', ').join(sql.Identifier(column[0]) for column in columns)
+          with (gzip.open(tmp_file, 'wb', compresslevel=6) as snapshot,
+                cursor.copy(sql.SQL('copy {} ({}) to stdout (format binary)')
+                            .format(sql.Identifier(table), column_list)) as copy):
+            for data in copy:
+              snapshot.write(data)
+          os.replace(tmp_file, snapshot_file)
+          num_bytes = snapshot_file.stat().st_size
+          metrics.count('snapshot_bytes', num_bytes)
+
+        self.manifest.setdefault(table, []).append({'hash': content_hash,
+                                                    'file': file_name,
+                                                    'taken': now,
+                                                    'checked': now,
+                                                    'rows': row.num_rows,
+                                                    'columns': columns,
+                                                    'primary_key': primary_key(cursor, table)})
+        self._prune(table)
+        self._save_manifest()
+        return SnapshotResult(table, status, row.num_rows, num_bytes)
+
+  def _prune(self, table: str):
+    """ Drop the table’s oldest snapshots beyond the number to keep, and delete any of their files
+        that no remaining snapshot uses.
+    """
+    snapshots = self.manifest[table]
+    dropped = snapshots[:-self.keep]
+    del snapshots[:-self.keep]
+    in_use = {snapshot['file'] for snapshot in snapshots}
+    for snapshot in dropped:
+      if snapshot['file'] not in in_use:
+        (self.snapshot_dir / snapshot['file']).unlink(missing_ok=True)
+
+  def restore(self, conn, *tables: str):
+    """ Replace the tables’ rows with their latest snapshots, in one transaction. A table that is
+        missing is re-created with its snapshot’s columns, defaults, and primary key (but no other
+        constraints or indexes).
+    """
+    entries = [(table, self.latest(table)) for table in tables]
+    missing = [table for table, entry in entries if entry is None]
+    if missing:
+      raise SnapshotError(f'No snapshot available for restoring {", ".join(missing)}')
+
+    with metrics.phase('restore'), conn.transaction():
+      with conn.cursor(row_factory=namedtuple_row) as cursor:
+        existing = [sql.Identifier(table) for table in tables if table_columns(cursor, table)]
+        if existing:
+          # Truncated together, so foreign keys among the tables do not get in the way.
+          cursor.execute(sql.SQL('truncate {}').format(sql.SQL(', ').join(existing)))
+        for table, entry in entries:
+          if not table_columns(cursor, table):
+            self._create(cursor, table, entry)
+          column_list = sql.SQL(', ').join(sql.Identifier(column[0])
+                                          for column in entry['columns'])
+          with (gzip.open(self.snapshot_dir / entry['file'], 'rb') as snapshot,
+                cursor.copy(sql.SQL('copy {} ({}) from stdin (format binary)')
+                            .format(sql.Identifier(table), column_list)) as copy):
+            while data := snapshot.read(COPY_BLOCK_SIZE):
+              copy.write(data)
+          # Move serial columns’ sequences past the restored values.
+          for name, *_ in entry['columns']:
+            cursor.execute('select pg_get_serial_sequence(%s, %s) as sequence', (table, name))
+            if cursor.fetchone().sequence is not None:
+              cursor.execute(sql.SQL("""
+                select setval(pg_get_serial_sequence(%s, %s), coalesce(max({}), 0) + 1, false)
+                  from {}
+              """).format(sql.Identifier(name), sql.Identifier(table)), (table, name))
+          metrics.count('rows_written', entry['rows'])
+
+  @staticmethod
+  def _create(cursor, table: str, entry: dict):
+    definitions = []
+    for name, column_type, not_null, default in entry['columns']:
+      definition = f'{sql.Identifier(name).as_string(cursor)} {column_type}'
+      if not_null:
+        definition += ' not null'
+      # Sequences go with the table, so serial columns come back as plain integers.
+      if default is not None and not default.startswith('nextval('):
+        definition += f' default {default}'
+      definitions.append(definition)
+    if entry['primary_key']:
+      key = ', '.join(sql.Identifier(name).as_string(cursor) for name in entry['primary_key'])
+      definitions.append(f'primary key ({key})')
+    cursor.execute(f'create table {sql.Identifier(table).as_string(cursor)} '
+                   f'({", ".join(definitions)})')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Snapshot or restore cuny_curriculum tables')
+  parser.add_argument('action', choices=['archive', 'restore', 'list'])
+  parser.add_argument('tables', nargs='*', metavar='table')
+  parser.add_argument('--dir', default=DEFAULT_SNAPSHOT_DIR,
+                      help=f'snapshot directory (default {DEFAULT_SNAPSHOT_DIR.name})')
+  args = parser.parse_args()
+  store = SnapshotStore(args.dir)
+
+  if args.action == 'list':
+    for table, snapshots in store.manifest.items():
+      for snapshot in snapshots:
+        print(f'{table:<20} {snapshot["taken"]}  {snapshot["rows"]:>7,} rows  {snapshot["file"]}')
+    sys.exit(0)
+
+  with psycopg.connect('dbname=cuny_curriculum', cursor_factory=CountingCursor) as conn:
+    if args.action == 'archive':
+      exit_status = 0
+      for table in args.tables or ARCHIVED_TABLES:
+        try:
+          print(store.snapshot(conn, table))
+        except SnapshotError as err:
+          print(f'  {err}')
+          exit_status = 1
+      sys.exit(exit_status)
+    else:
+      if not args.tables:
+        sys.exit('No tables to restore.')
+      try:
+        store.restore(conn, *args.tables)
+      except SnapshotError as err:
+        sys.exit(f'ERROR: {err}')
+      print(f'Restored {", ".join(args.tables)}')
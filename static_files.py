@@ -0,0 +1,241 @@
+""" Ready-to-serve files of the registered programs table, written by generate_html.py.
+
+    For all target institutions together, and for each one separately, there is an html table and
+    CSV and JSON downloads:
+      registered_programs.html, .csv, .json
+      registered_programs_qns.html, .csv, .json (and so on)
+    Each file is written along with gzip (.gz) and, if the brotli package is installed, brotli (.br)
+    versions, so a web server can send whichever the client accepts without compressing anything.
+
+    The rows are also split into shards, one for each target institution and HEGIS area (from the
+    hegis_areas table), so that a page can load just the rows it shows. Each shard is a fragment of
+    html table rows, shards/<institution>_<area id>.html (shards/<institution>_none.html for rows
+    whose HEGIS code is not in hegis_codes). shards/index.json lists the headings, and each shard’s
+    name, institution, area, row count, and ETag.
+
+    manifest.json (in each directory) gives each file’s ETag (a hash of its content), its size, and
+    the sizes of its compressed versions. A file whose content has not changed is not rewritten, so
+    its modification time and ETag stay valid for clients that cached it.
+"""
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+
+from datetime import datetime
+from metrics import metrics
+from pathlib import Path
+from psycopg.rows import namedtuple_row
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+DEFAULT_STATIC_DIR = Path(__file__).parent / 'static'
+
+# The cells of the html and csv columns, in order.
+HEADINGS = ['Program Code', 'Unit Code', 'Institution', 'Title', 'Formats', 'HEGIS', 'Award',
+            'CIP', 'CUNY Program(s)', 'Certificate or License', 'Accreditation',
+            'First Registration Date', 'Last Registration Action', 'TAP', 'APTS', 'VVTA']
+
+HTML_TABLE_HEAD = ('<table class="registered-programs">\n<thead><tr>'
+                   + ''.join(f'<th>{heading}</th>' for heading in HEADINGS)
+                   + '</tr></thead>\n<tbody>\n')
+HTML_TABLE_TAIL = '</tbody>\n</table>\n'
+
+# File name suffixes of the compressed versions.
+SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+MEDIA_TYPES = {'.html': 'text/html; charset=utf-8',
+               '.csv': 'text/csv; charset=utf-8',
+               '.json': 'application/json'}
+
+
+class ProgramRow(NamedTuple):
+  target_institution: str
+  hegis_area_id: Optional[int]
+  hegis_area: Optional[str]
+  html: str
+  csv: List[str]
+
+
+# program_rows()
+# -------------------------------------------------------------------------------------------------
+def program_rows(conn) -> List[ProgramRow]:
+  """ The generated html and csv values of the registered_programs table, with the HEGIS area of
+      each row, in title order. Rows that share a (target_institution, program_code, award) key
+      have the same values, and appear once.
+  """
+  with conn.cursor(row_factory=namedtuple_row) as cursor:
+    cursor.execute("""
+                   select r.target_institution, r.program_code, r.award, r.html, r.csv,
+                          a.id as hegis_area_id, a.hegis_area
+                     from registered_programs r
+                          left join hegis_codes h on h.hegis_code = r.hegis
+                          left join hegis_areas a on a.id = h.area_id
+                    where r.html != ''
+                    order by r.title, r.program_code
+                   """)
+    rows = []
+    seen = set()
+    for row in cursor:
+      key = (row.target_institution, row.program_code, row.award)
+      if key not in seen:
+        seen.add(key)
+        rows.append(ProgramRow(row.target_institution, row.hegis_area_id, row.hegis_area,
+                               row.html, json.loads(row.csv)))
+  return rows
+
+
+def html_rows(rows: Iterable[ProgramRow]) -> str:
+  return ''.join(f'{row.html}\n' for row in rows)
+
+
+def html_table(rows: Iterable[ProgramRow]) -> str:
+  return HTML_TABLE_HEAD + html_rows(rows) + HTML_TABLE_TAIL
+
+
+def csv_file(rows: Iterable[ProgramRow]) -> str:
+  output = io.StringIO()
+  writer = csv.writer(output)
+  writer.writerow(['Target Institution'] + HEADINGS)
+  writer.writerows([row.target_institution] + row.csv for row in rows)
+  return output.getvalue()
+
+
+def json_file(rows: Iterable[ProgramRow]) -> str:
+  return json.dumps({'headings': ['Target Institution'] + HEADINGS,
+                     'rows': [[row.target_institution] + row.csv for row in rows]},
+                    ensure_ascii=False, separators=(',', ':'))
+
+
+def etag(content: bytes) -> str:
+  """ Strong ETag for the content. """
+  return f'"{hashlib.sha256(content).hexdigest()[:32]}"'
+
+
+# class StaticWriter
+# -------------------------------------------------------------------------------------------------
+class StaticWriter(object):
+  """ Writes files, with their compressed versions, to a directory, and keeps its manifest.
+  """
+
+  def __init__(self, static_dir=DEFAULT_STATIC_DIR):
+    self.static_dir = Path(static_dir)
+    self.manifest_file = self.static_dir / 'manifest.json'
+    try:
+      self.previous = json.loads(self.manifest_file.read_text())['files']
+    except FileNotFoundError:
+      self.previous = dict()
+    self.files: Dict[str, dict] = dict()
+    self.num_written = 0
+
+  def _write(self, name: str, content: bytes):
+    path = self.static_dir / name
+    tmp_path = path.with_name(f'{name}.{os.getpid()}.tmp')
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+    metrics.count('static_bytes', len(content))
+
+  def add(self, name: str, text: str):
+    """ Write the file and its compressed versions, unless the manifest shows they are already
+        there with the same content.
+    """
+    content = text.encode('utf-8')
+    tag = etag(content)
+    previous = self.previous.get(name)
+    encodings = ('gzip', 'br') if brotli is not None else ('gzip', )
+    if (previous is not None and previous['etag'] == tag
+        and set(previous['encodings']) == set(encodings)
+        and all((self.static_dir / file_name).exists()
+                for file_name in [name] + [f'{name}{SUFFIXES[e]}' for e in encodings])):
+      self.files[name] = previous
+      return
+
+    self.static_dir.mkdir(parents=True, exist_ok=True)
+    self._write(name, content)
+    sizes = dict()
+    compressed = gzip.compress(content, compresslevel=9, mtime=0)
+    self._write(f'{name}.gz', compressed)
+    sizes['gzip'] = len(compressed)
+    if brotli is not None:
+      compressed = brotli.compress(content, quality=11)
+      self._write(f'{name}.br', compressed)
+      sizes['br'] = len(compressed)
+    else:
+      (self.static_dir / f'{name}.br').unlink(missing_ok=True)
+    self.files[name] = {'etag': tag,
+                        'content_type': MEDIA_TYPES[Path(name).suffix],
+                        'bytes': len(content),
+                        'encodings': sizes}
+    self.num_written += 1
+
+  def finish(self, generated: Optional[datetime] = None):
+    """ Remove files that are no longer produced, and write the manifest.
+    """
+    for name in set(self.previous) - set(self.files):
+      for suffix in [''] + list(SUFFIXES.values()):
+        (self.static_dir / f'{name}{suffix}').unlink(missing_ok=True)
+    generated = generated or datetime.now()
+    self._write('manifest.json',
+                (json.dumps({'generated': generated.isoformat(timespec='seconds'),
+                             'files': self.files}, indent=2) + '\n').encode('utf-8'))
+
+
+# write_shards()
+# -------------------------------------------------------------------------------------------------
+def write_shards(rows: List[ProgramRow], shard_dir: Path) -> int:
+  """ Write a fragment of html rows for each target institution and HEGIS area, and the index of
+      the fragments. Returns the number of files whose content changed.
+  """
+  shards: Dict[tuple, List[ProgramRow]] = dict()
+  for row in rows:
+    shards.setdefault((row.target_institution, row.hegis_area_id), []).append(row)
+
+  writer = StaticWriter(shard_dir)
+  index = []
+  for (institution, area_id), shard_rows in sorted(shards.items(),
+                                                    key=lambda item: (item[0][0],
+                                                                      item[0][1] or 0)):
+    name = f'{institution}_{"none" if area_id is None else area_id}.html'
+    writer.add(name, html_rows(shard_rows))
+    index.append({'name': name,
+                  'target_institution': institution,
+                  'hegis_area_id': area_id,
+                  'hegis_area': shard_rows[0].hegis_area,
+                  'rows': len(shard_rows),
+                  'etag': writer.files[name]['etag']})
+  writer.add('index.json', json.dumps({'headings': HEADINGS, 'shards': index},
+                                     ensure_ascii=False, separators=(',', ':')))
+  writer.finish()
+  return writer.num_written
+
+
+# write_static_files()
+# -------------------------------------------------------------------------------------------------
+def write_static_files(conn, static_dir=DEFAULT_STATIC_DIR) -> int:
+  """ Write the html, CSV, and JSON files for all target institutions and for each one. Returns
+      the number of files whose content changed.
+  """
+  with metrics.phase('static_files'):
+    rows = program_rows(conn)
+    by_institution: Dict[str, List[ProgramRow]] = dict()
+    for row in rows:
+      by_institution.setdefault(row.target_institution, []).append(row)
+
+    outputs = [('registered_programs', rows)]
+    outputs += [(f'registered_programs_{institution}', institution_rows)
+                for institution, institution_rows in sorted(by_institution.items())]
+
+    writer = StaticWriter(static_dir)
+    for name, output_rows in outputs:
+      writer.add(f'{name}.html', html_table(output_rows))
+      writer.add(f'{name}.csv', csv_file(output_rows))
+      writer.add(f'{name}.json', json_file(output_rows))
+    writer.finish()
+    num_shards = write_shards(rows, Path(static_dir, 'shards'))
+  return writer.num_written + num_shards
@@ -0,0 +1,279 @@
+#! /usr/local/bin/python3
+""" Run the registered programs update as a graph of stages, in one process.
+
+    Each stage runs as soon as the stages it comes after have finished, so stages that do not
+    depend on each other run at the same time:
+
+      archive
+        then hegis_codes, nys_institutions, and program_formats, concurrently
+        registered_programs, after nys_institutions
+        generate_html, after hegis_codes, nys_institutions, and registered_programs
+
+    The registered_programs stage scrapes the CUNY institutions on a pool of worker threads, and
+    writes each one’s rows as soon as it has been scraped; registered_programs_db holds an advisory
+    lock on the institution while its rows are written. All stages share one pool of database
+    connections, and one NYSED rate limiter.
+
+    The archive stage snapshots the tables that will be rebuilt (see snapshots.py). A stage that
+    fails is reported and, like update_registered_programs.sh used to do, the tables it rebuilds
+    are restored from their latest snapshots. The stages after it still run, using the restored
+    tables, unless they require it to have succeeded: nothing runs unless the archive stage
+    succeeds. Each stage’s status and wall time are printed as it finishes, followed by a
+    summary of the whole run.
+
+    A run that is to be retried with --resume if it fails is started with --no_restore: restoring
+    registered_programs would revert the institutions that were written before the failure, and
+    the retry, which skips the institutions its checkpoints show are done, would not write them
+    again. The retry is given the same --run_id, and does not snapshot registered_programs, so that
+    if it fails too the table is restored to what it was before the first attempt.
+"""
+import argparse
+import sys
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Callable, Dict, List, Sequence
+
+from psycopg_pool import ConnectionPool
+
+from checkpoint import Checkpoint, DEFAULT_CHECKPOINT_DIR, default_run_id
+from generate_html import generate_html
+from hegis_codes import update_hegis_codes
+from metrics import CountingCursor, metrics, save_on_exit
+from nys_institutions import update_nys_institutions
+from nysed_fetch import configure
+from program_formats import update_program_formats
+from registered_program import ProgramRegistry
+from registered_programs import (known_institutions, load_known_institutions, scrape_programs,
+                                 write_institution)
+from snapshots import ARCHIVED_TABLES, SnapshotStore
+from static_files import write_static_files
+
+CONNINFO = 'dbname=cuny_curriculum'
+
+_print_lock = threading.Lock()
+
+
+def report(*args):
+  """ Print a line of the run’s log, without interleaving it with another thread’s. """
+  with _print_lock:
+    print(*args, flush=True)
+
+
+# class Stage
+# -------------------------------------------------------------------------------------------------
+class Stage(object):
+  """ One step of the update. It runs once the stages named in after have finished (whether or not
+      they succeeded) and those named in requires have succeeded. If it fails, the restore tables
+      are restored from their latest archives.
+  """
+
+  def __init__(self, name: str, run: Callable[[], None], after: Sequence[str] = (),
+               requires: Sequence[str] = (), restore: Sequence[str] = ()):
+    self.name = name
+    self.run = run
+    self.after = tuple(after)
+    self.requires = tuple(requires)
+    self.restore = tuple(restore)
+    self.status = 'pending'
+    self.seconds = 0.0
+    self.note = ''
+
+  def __str__(self):
+    note = f'  {self.note}' if self.note else ''
+    return f'{self.name:<20} {self.status:<9} {self.seconds:7.1f} sec{note}'
+
+
+# run_stage()
+# -------------------------------------------------------------------------------------------------
+def run_stage(stage: Stage, restore: Callable[[Sequence[str]], None]):
+  """ Run one stage, restoring its tables with restore() if it fails, and report the outcome.
+  """
+  start = time.perf_counter()
+  try:
+    with metrics.phase(stage.name):
+      stage.run()
+    stage.status = 'ok'
+  except (Exception, SystemExit) as err:
+    # Scripts’ functions report some errors by exiting; in a worker thread that just ends the
+    # stage.
+    stage.status = 'FAILED'
+    stage.note = str(err) or type(err).__name__
+    if stage.restore:
+      try:
+        restore(stage.restore)
+        stage.note += f'; restored {", ".join(stage.restore)} from snapshot'
+      except Exception as err:
+        stage.note += f'; RESTORE FAILED: {err}'
+  stage.seconds = time.perf_counter() - start
+  report(stage)
+
+
+# run_stages()
+# -------------------------------------------------------------------------------------------------
+def run_stages(stages: List[Stage], restore: Callable[[Sequence[str]], None]) -> bool:
+  """ Run the stages, each as soon as it can. Returns True if every stage succeeded.
+  """
+  by_name: Dict[str, Stage] = {stage.name: stage for stage in stages}
+  for stage in stages:
+    for name in stage.after + stage.requires:
+      if name not in by_name:
+        raise ValueError(f'{stage.name}: unknown stage {name}')
+
+  pending = list(stages)
+  running = dict()
+  with ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix='stage') as executor:
+    while pending or running:
+      ready = [stage for stage in pending
+               if all(by_name[name].status not in ('pending', 'running')
+                      for name in stage.after + stage.requires)]
+      for stage in ready:
+        pending.remove(stage)
+        failed = [name for name in stage.requires if by_name[name].status != 'ok']
+        if failed:
+          stage.status = 'skipped'
+          stage.note = f'{", ".join(failed)} did not succeed'
+          report(stage)
+        else:
+          stage.status = 'running'
+          running[executor.submit(run_stage, stage, restore)] = stage
+      if not running:
+        if pending and not ready:
+          raise ValueError(f'Circular dependencies among {[stage.name for stage in pending]}')
+        continue
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        del running[future]
+  return all(stage.status == 'ok' for stage in stages)
+
+
+# update_registered_programs()
+# -------------------------------------------------------------------------------------------------
+def update_registered_programs(pool: ConnectionPool, jobs: int, workers: int, resume: bool,
+                               run_id: str, checkpoint_dir=DEFAULT_CHECKPOINT_DIR):
+  """ Scrape all CUNY institutions, jobs at a time, writing each one’s rows as it completes. Raises
+      the first failure after the other institutions have finished.
+  """
+  # The institutions were read when registered_programs was imported; the nys_institutions stage
+  # may since have changed them.
+  with pool.connection() as conn:
+    load_known_institutions(conn)
+  institutions = sorted(inst for inst in known_institutions if known_institutions[inst][2])
+
+  # Detail pages of M/I programs are fetched once, by whichever institution gets to them first.
+  shared_pages = dict()
+  phases = metrics.current_phases()
+
+  def scrape_institution(institution: str) -> Checkpoint:
+    checkpoint = Checkpoint(institution, checkpoint_dir, run_id)
+    if resume and checkpoint.is_done():
+      return checkpoint
+    with metrics.within(phases), metrics.phase(institution):
+      programs = ProgramRegistry()
+      for _ in scrape_programs(institution, programs, workers=workers, shared_pages=shared_pages,
+                               checkpoint=checkpoint, resume=resume):
+        pass
+      with pool.connection() as conn:
+        write_institution(conn, institution, programs, incremental=True)
+      checkpoint.finish()
+    return checkpoint
+
+  with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='scrape') as executor:
+    futures = {executor.submit(scrape_institution, institution): institution
+               for institution in institutions}
+  failures = [(institution, future.exception()) for future, institution in futures.items()
+              if future.exception() is not None]
+  if failures:
+    institution, err = failures[0]
+    raise RuntimeError(f'{len(failures)} of {len(institutions)} institutions failed; '
+                       f'{institution}: {err or type(err).__name__}')
+
+  for future in futures:
+    future.result().remove()
+  with pool.connection() as conn:
+    conn.execute("update updates set update_date = CURRENT_DATE "
+                 "where table_name = 'registered_programs'")
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Update NYS registered programs and related tables')
+  parser.add_argument('--jobs', type=int, default=4,
+                      help='institutions to scrape at the same time (default 4)')
+  parser.add_argument('--workers', type=int, default=1,
+                      help='concurrent detail-page requests for each institution (default 1)')
+  parser.add_argument('--rate', type=float, default=None,
+                      help='limit requests to NYSED to this many per second, overall')
+  parser.add_argument('--resume', action='store_true', default=False,
+                      help='continue an interrupted run from its checkpoints')
+  parser.add_argument('--run_id', default=default_run_id(),
+                      help='identifies the run in its checkpoints; --resume uses only checkpoints '
+                           'with the same run_id (default today’s date)')
+  parser.add_argument('--no_restore', action='store_true', default=False,
+                      help='do not restore the tables of a failed stage (for a run that will be '
+                           'retried with --resume)')
+  parser.add_argument('--full', action='store_true', default=False,
+                      help='regenerate html and csv for all rows, not just changed ones')
+  args = parser.parse_args()
+  save_on_exit(__file__)
+  configure(rate=args.rate)
+
+  report(f'Start update_pipeline.py at {datetime.now():%Y-%m-%d %H:%M:%S}')
+  start = time.perf_counter()
+  with ConnectionPool(CONNINFO, min_size=2, max_size=args.jobs + 4,
+                      kwargs={'cursor_factory': CountingCursor}, open=True) as pool:
+
+    def in_pool(update: Callable) -> Callable[[], None]:
+      """ A stage that runs update() with a connection from the pool. """
+      def run():
+        with pool.connection() as conn:
+          update(conn)
+      return run
+
+    store = SnapshotStore()
+
+    def archive():
+      # A resumed run keeps registered_programs’ snapshot from before the first attempt, which
+      # may have written some of its institutions.
+      tables = [table for table in ARCHIVED_TABLES
+                if not (args.resume and table == 'registered_programs')]
+      with pool.connection() as conn:
+        for table in tables:
+          report(store.snapshot(conn, table))
+
+    def restore(tables: Sequence[str]):
+      with pool.connection() as conn:
+        store.restore(conn, *tables)
+
+    def html():
+      with pool.connection() as conn:
+        num_generated, total_rows = generate_html(full=args.full, conn=conn)
+        num_files = write_static_files(conn)
+      report(f'  {num_generated:,} of {total_rows:,} rows regenerated; '
+             f'{num_files:,} static files updated')
+
+    stages = [
+        Stage('archive', archive),
+        # hegis_codes and nys_institutions are replaced in single transactions, so a failure
+        # leaves them as they were.
+        Stage('hegis_codes', in_pool(update_hegis_codes), requires=['archive']),
+        Stage('nys_institutions', in_pool(update_nys_institutions), requires=['archive']),
+        Stage('program_formats', in_pool(update_program_formats), requires=['archive']),
+        Stage('registered_programs',
+              lambda: update_registered_programs(pool, args.jobs, args.workers, args.resume,
+                                                 args.run_id),
+              after=['nys_institutions'], requires=['archive'],
+              restore=[] if args.no_restore else ['registered_programs']),
+        Stage('generate_html', html,
+              after=['hegis_codes', 'nys_institutions', 'registered_programs'],
+              requires=['archive']),
+    ]
+    ok = run_stages(stages, restore)
+
+  report(f'\n{"Stage":<20} {"Status":<9} {"Time":>11}')
+  for stage in stages:
+    report(stage)
+  report(f'End update_pipeline.py at {datetime.now():%Y-%m-%d %H:%M:%S}; '
+         f'{time.perf_counter() - start:0.1f} sec')
+  sys.exit(0 if ok else 1)